@@ -0,0 +1,195 @@
+"""Compressed, deduplicated archive of the daily ani.gamer.com.tw snapshots.
+
+Replaces the raw source/{date}.html + {date}_cookies.json files. Every
+snapshot is stored once as archive/blobs/{sha1[:2]}/{sha1}.{gz|zst}, named by
+the SHA-1 of its raw content, so identical days share a blob; archive/index.json
+maps date -> {kind: {sha1, size, codec}} for the kinds 'html', 'cookies'
+(cookie lists of the legacy files) and 'clearance' ({user_agent, cookies} of
+a FlareSolverr solve, reused by fetch.py).
+Blobs are zstd-compressed when the zstandard package is installed and gzip
+otherwise (mtime 0, so rewriting a blob never changes it in git); both are
+always readable as long as the codec is installed.
+
+Readers use SnapshotArchive.open()/read() instead of open() on source/:
+
+    archive = SnapshotArchive()
+    with archive.open(archive.dates()[-1]) as f:
+        schedule = extract_schedule(f)
+
+    python archive.py import      # move source/ into the archive
+    python archive.py stats       # compression ratio and read throughput
+"""
+
+import argparse
+import builtins
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.path.join(SCRIPT_DIR, 'archive')
+SOURCE_DIR = os.path.join(SCRIPT_DIR, 'source')
+
+CODEC = 'zst' if HAS_ZSTD else 'gz'
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+KINDS = {'html': '.html', 'cookies': '_cookies.json'}  # kind -> legacy source/ file suffix
+
+
+def compress(data, codec=CODEC):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress(data, codec):
+    if codec == 'zst':
+        if not HAS_ZSTD:
+            raise RuntimeError("zstandard is required to read .zst snapshots (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class SnapshotArchive:
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_path)
+
+    def blob_path(self, sha1, codec):
+        return os.path.join(self.root, 'blobs', sha1[:2], f"{sha1}.{codec}")
+
+    def dates(self, kind='html'):
+        """Snapshot dates that have `kind`, oldest first."""
+        return sorted(d for d, entry in self.index.items() if kind in entry)
+
+    def entry(self, date, kind='html'):
+        """{sha1, size, codec} of one snapshot, or None."""
+        return self.index.get(date, {}).get(kind)
+
+    def put(self, date, data, kind='html'):
+        """Store a snapshot (str or bytes); returns its SHA-1. Call save() afterwards."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        sha1 = hashlib.sha1(data).hexdigest()
+        # Reuse the blob of an identical earlier snapshot, whatever its codec
+        for entry in self.index.values():
+            same = next((e for e in entry.values() if e['sha1'] == sha1), None)
+            if same:
+                codec = same['codec']
+                break
+        else:
+            codec = CODEC
+            path = self.blob_path(sha1, codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(compress(data, codec))
+        self.index.setdefault(date, {})[kind] = {'sha1': sha1, 'size': len(data), 'codec': codec}
+        return sha1
+
+    def read_bytes(self, date, kind='html'):
+        entry = self.entry(date, kind)
+        if entry is None:
+            raise KeyError(f"No {kind} snapshot for {date}")
+        with open(self.blob_path(entry['sha1'], entry['codec']), 'rb') as f:
+            return decompress(f.read(), entry['codec'])
+
+    def read(self, date, kind='html'):
+        return self.read_bytes(date, kind).decode('utf-8')
+
+    def open(self, date, kind='html'):
+        """Text stream over one snapshot, a drop-in for open(path, encoding='utf-8').
+
+        Decompresses as it is read, so a streaming reader never holds the
+        whole snapshot in memory.
+        """
+        entry = self.entry(date, kind)
+        if entry is None:
+            raise KeyError(f"No {kind} snapshot for {date}")
+        path = self.blob_path(entry['sha1'], entry['codec'])
+        if entry['codec'] == 'zst':
+            if not HAS_ZSTD:
+                raise RuntimeError("zstandard is required to read .zst snapshots (pip install zstandard)")
+            raw = builtins.open(path, 'rb')
+            return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), encoding='utf-8')
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    def read_json(self, date, kind='cookies'):
+        return json.loads(self.read_bytes(date, kind))
+
+
+def import_source(archive, source_dir=SOURCE_DIR, keep=False):
+    """Move legacy source/ files into the archive; returns the number imported."""
+    imported = 0
+    for name in sorted(os.listdir(source_dir)):
+        for kind, suffix in KINDS.items():
+            if name.endswith(suffix) and not (kind == 'html' and name.endswith(KINDS['cookies'])):
+                path = os.path.join(source_dir, name)
+                with open(path, 'rb') as f:
+                    archive.put(name[:-len(suffix)], f.read(), kind)
+                imported += 1
+                if not keep:
+                    os.remove(path)
+                break
+    archive.save()
+    if not keep and not os.listdir(source_dir):
+        os.rmdir(source_dir)
+    return imported
+
+
+def stats(archive):
+    """Print raw vs stored size and full read throughput."""
+    raw = sum(e['size'] for entry in archive.index.values() for e in entry.values())
+    blobs = {(e['sha1'], e['codec']) for entry in archive.index.values() for e in entry.values()}
+    stored = sum(os.path.getsize(archive.blob_path(sha1, codec)) for sha1, codec in blobs)
+    count = sum(len(entry) for entry in archive.index.values())
+    print(f"{count} snapshots in {len(archive.index)} days, {len(blobs)} unique blobs")
+    print(f"raw {raw / 1024 / 1024:.2f} MB -> stored {stored / 1024 / 1024:.2f} MB "
+          f"(ratio {raw / stored if stored else 0:.1f}x)")
+
+    start = time.perf_counter()
+    read = 0
+    for date in archive.dates():
+        read += len(archive.read_bytes(date))
+    seconds = time.perf_counter() - start
+    print(f"read all html: {read / 1024 / 1024:.2f} MB in {seconds * 1000:.0f} ms "
+          f"({read / 1024 / 1024 / seconds if seconds else 0:.0f} MB/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the compressed baha snapshot archive")
+    parser.add_argument('command', choices=['import', 'stats'])
+    parser.add_argument('--keep', action='store_true', help='import: keep the source/ files')
+    args = parser.parse_args()
+
+    archive = SnapshotArchive()
+    if args.command == 'import':
+        if os.path.isdir(SOURCE_DIR):
+            print(f"Imported {import_source(archive, keep=args.keep)} files from {SOURCE_DIR}")
+        else:
+            print(f"No {SOURCE_DIR}, nothing to import")
+    stats(archive)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,22 +3,99 @@
 import re
 import json
 import os
+import time
+import argparse
 from datetime import datetime
 
+from archive import SnapshotArchive
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-SOURCE_DIR = os.path.join(SCRIPT_DIR, 'source')
 OUTPUT = os.path.join(SCRIPT_DIR, 'schedule.html')
 SCHEDULE_JSON = os.path.join(SCRIPT_DIR, 'schedule.json')
 
 DAYS = ['週一', '週二', '週三', '週四', '週五', '週六', '週日']
+CHUNK_SIZE = 1 << 16
 DAY_COLORS = {
     '週一': '#e74c3c', '週二': '#e67e22', '週三': '#f1c40f',
     '週四': '#2ecc71', '週五': '#3498db', '週六': '#9b59b6', '週日': '#e91e63'
 }
 
 
-def extract_schedule(html):
-    """Extract schedule data from baha HTML."""
+class ScheduleParser:
+    """Single-pass, event-based extraction of day/time/title records.
+
+    Like html.parser, text is pushed in with feed() and close(), so a snapshot
+    can be parsed from a stream. One combined pattern tokenizes the three
+    elements that matter, `<h3 class="day-title">`, `<span
+    class="text-anime-time">` and `<p class="text-anime-name">`, in document
+    order. Only a short tail is kept between chunks in case a token is split.
+    Each title is paired with the first time seen since the previous title in
+    the same day, and only the first block of each day is used. Titles keep
+    their raw markup. All of this matches the original regex extractor.
+    """
+
+    TOKEN = re.compile(
+        r'<h3 class="day-title">([^<]*)</h3>'
+        r'|<span class="text-anime-time">(\d+:\d+)</span>'
+        r'|<p class="text-anime-name">(.*?)</p>', re.DOTALL)
+    KEEP = 4096  # Longest token expected to straddle a chunk boundary
+
+    def __init__(self):
+        self.schedule = {}
+        self.day = None         # Day whose entries are being collected
+        self.pending_time = None
+        self.buffer = ''
+
+    def feed(self, data):
+        self.buffer += data
+        end = 0
+        for match in self.TOKEN.finditer(self.buffer):
+            day, time_text, name = match.groups()
+            if day is not None:
+                self.handle_day(day)
+            elif time_text is not None:
+                self.handle_time(time_text)
+            else:
+                self.handle_name(name)
+            end = match.end()
+        self.buffer = self.buffer[max(end, len(self.buffer) - self.KEEP):]
+
+    def close(self):
+        self.buffer = ''
+
+    def handle_day(self, title):
+        if title not in DAYS:
+            return
+        # Any day header ends the current block; a repeated day is not collected again
+        self.pending_time = None
+        self.day = None if title in self.schedule else title
+        if self.day:
+            self.schedule[title] = []
+
+    def handle_time(self, text):
+        if self.day and self.pending_time is None:
+            self.pending_time = text
+
+    def handle_name(self, name):
+        if self.day and self.pending_time:
+            self.schedule[self.day].append({'time': self.pending_time, 'name': name.strip()})
+            self.pending_time = None
+
+
+def extract_schedule(source, chunk_size=CHUNK_SIZE):
+    """Extract schedule data from baha HTML (a string or a text stream read in chunks)."""
+    parser = ScheduleParser()
+    if isinstance(source, str):
+        parser.feed(source)
+    else:
+        for chunk in iter(lambda: source.read(chunk_size), ''):
+            parser.feed(chunk)
+    parser.close()
+    return {day: parser.schedule[day] for day in DAYS if day in parser.schedule}
+
+
+def extract_schedule_regex(html):
+    """Original find/regex extractor, kept as the reference for --bench."""
     schedule = {}
     for day in DAYS:
         idx = html.find(f'<h3 class="day-title">{day}</h3>')
@@ -36,6 +113,37 @@ def extract_schedule(html):
     return schedule
 
 
+def benchmark():
+    """Compare the streaming parser with the regex extractor on every archived snapshot."""
+    archive = SnapshotArchive()
+    files = archive.dates()
+    totals = {'regex': 0.0, 'stream': 0.0}
+    size = 0
+    mismatches = []
+    for name in files:
+        html = archive.read(name)
+        size += len(html.encode('utf-8'))
+
+        start = time.perf_counter()
+        expected = extract_schedule_regex(html)
+        totals['regex'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with archive.open(name) as f:
+            result = extract_schedule(f)
+        totals['stream'] += time.perf_counter() - start
+
+        if result != expected:
+            mismatches.append(name)
+
+    mb = size / 1024 / 1024
+    for label, seconds in totals.items():
+        print(f"{label:>6}: {seconds * 1000:.0f} ms total, {seconds * 1000 / max(len(files), 1):.1f} ms/file, "
+              f"{mb / seconds if seconds else 0:.1f} MB/s")
+    print(f"{len(files)} snapshots ({mb:.1f} MB), {len(files) - len(mismatches)} identical"
+          + (f", differ: {', '.join(mismatches)}" if mismatches else ""))
+
+
 def build_html(schedule, updated):
     """Build standalone HTML page with light theme like itv6.jp."""
     # Build time slots (all unique times sorted)
@@ -255,25 +363,12 @@ td {{
 </html>'''
 
 
-def main():
-    # Find latest source file
-    source_files = sorted([f for f in os.listdir(SOURCE_DIR) if f.endswith('.html') and not f.endswith('_cookies.json')])
-    if not source_files:
-        print("No source files found")
-        return
-
-    latest = source_files[-1]
-    source_path = os.path.join(SOURCE_DIR, latest)
-    updated = latest.replace('.html', '')
-
-    print(f"Using source: {latest}")
-    with open(source_path, 'r', encoding='utf-8') as f:
-        html = f.read()
-
-    schedule = extract_schedule(html)
+def build(source, updated):
+    """Extract the schedule from one snapshot (str or text stream) and write schedule.json/html."""
+    schedule = extract_schedule(source)
     if not schedule:
         print("No schedule data found in source")
-        return
+        return None
 
     # Save JSON
     with open(SCHEDULE_JSON, 'w', encoding='utf-8') as f:
@@ -289,6 +384,31 @@ def main():
     total = sum(len(v) for v in schedule.values())
     print(f"Total: {total} anime across {len(schedule)} days")
 
+    return schedule
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bench', action='store_true',
+                        help='Benchmark the parser against the regex extractor on all snapshots')
+    args = parser.parse_args()
+    if args.bench:
+        benchmark()
+        return
+
+    # Find latest snapshot
+    archive = SnapshotArchive()
+    dates = archive.dates()
+    if not dates:
+        print("No source snapshots found")
+        return
+
+    updated = dates[-1]
+
+    print(f"Using source: {updated}")
+    with archive.open(updated) as f:
+        build(f, updated)
+
 
 if __name__ == '__main__':
     main()
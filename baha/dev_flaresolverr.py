@@ -0,0 +1,140 @@
+"""Local stand-in for FlareSolverr's /v1 API and a Cloudflare-protected page, for testing fetch.py.
+
+One server plays both sides:
+  POST /v1   sessions.create / sessions.list / sessions.destroy / request.get.
+             A solve takes --solve-delay seconds, except inside a session that
+             already solved, and hands out a cf_clearance cookie + user agent.
+  GET  /*    the page (latest archived snapshot); without a valid
+             cf_clearance cookie and matching User-Agent it returns the
+             403 "Just a moment..." challenge instead.
+
+    python dev_flaresolverr.py --port 8191
+    FLARESOLVERR_URL=http://localhost:8191/v1 BAHA_URL=http://localhost:8191/ python fetch.py
+"""
+
+import argparse
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from archive import SnapshotArchive
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36'
+CHALLENGE_PAGE = '<html><head><title>Just a moment...</title></head><body>challenge-platform</body></html>'
+FALLBACK_PAGE = '<html><head><title>動畫瘋</title></head><body>' + 'x' * 6000 + '</body></html>'
+
+
+class Solver:
+    """In-memory state: sessions (name -> clearance token or None) and issued tokens."""
+
+    def __init__(self, solve_delay, clearance_ttl):
+        self.solve_delay = solve_delay
+        self.clearance_ttl = clearance_ttl
+        self.sessions = {}
+        self.tokens = {}  # token -> expiry
+        self.solves = 0
+        self.lock = threading.Lock()
+
+    def solve(self, session=None):
+        with self.lock:
+            token = self.sessions.get(session)
+            if token and self.tokens.get(token, 0) > time.time():
+                return token, False
+        time.sleep(self.solve_delay)
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + self.clearance_ttl
+            self.solves += 1
+            if session in self.sessions:
+                self.sessions[session] = token
+        return token, True
+
+    def valid(self, token, user_agent):
+        with self.lock:
+            return user_agent == USER_AGENT and self.tokens.get(token, 0) > time.time()
+
+
+def make_handler(solver, page):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type='application/json'):
+            data = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path != '/v1':
+                return self.send(404, json.dumps({'status': 'error', 'message': 'not found'}))
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            cmd = request.get('cmd')
+            session = request.get('session')
+            if cmd == 'sessions.list':
+                result = {'status': 'ok', 'sessions': sorted(solver.sessions)}
+            elif cmd == 'sessions.create':
+                session = session or secrets.token_hex(8)
+                solver.sessions.setdefault(session, None)
+                result = {'status': 'ok', 'message': 'Session created successfully.', 'session': session}
+            elif cmd == 'sessions.destroy':
+                if solver.sessions.pop(session, 'missing') == 'missing':
+                    result = {'status': 'error', 'message': "The session doesn't exist."}
+                else:
+                    result = {'status': 'ok', 'message': 'The session has been removed.'}
+            elif cmd == 'request.get':
+                if session and session not in solver.sessions:
+                    result = {'status': 'error', 'message': "The session doesn't exist."}
+                else:
+                    token, solved = solver.solve(session)
+                    print(f"request.get {request.get('url')} session={session} "
+                          f"{'solved' if solved else 'reused clearance'} (solves: {solver.solves})")
+                    result = {'status': 'ok', 'message': 'Challenge solved!' if solved else 'Challenge not detected!',
+                              'solution': {
+                                  'url': request.get('url'), 'status': 200, 'response': page,
+                                  'cookies': [{'name': 'cf_clearance', 'value': token, 'domain': 'localhost',
+                                               'path': '/', 'httpOnly': True, 'secure': True}],
+                                  'userAgent': USER_AGENT}}
+            else:
+                result = {'status': 'error', 'message': f'Request parameter \'cmd\' = \'{cmd}\' is invalid.'}
+            self.send(200 if result['status'] == 'ok' else 500, json.dumps(result, ensure_ascii=False))
+
+        def do_GET(self):
+            cookies = dict(part.strip().split('=', 1) for part in self.headers.get('Cookie', '').split(';')
+                           if '=' in part)
+            if solver.valid(cookies.get('cf_clearance'), self.headers.get('User-Agent')):
+                print(f"GET {self.path}: clearance accepted")
+                self.send(200, page, 'text/html')
+            else:
+                print(f"GET {self.path}: challenge")
+                self.send(403, CHALLENGE_PAGE, 'text/html')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local FlareSolverr + Cloudflare stand-in for fetch.py")
+    parser.add_argument('--port', type=int, default=8191)
+    parser.add_argument('--solve-delay', type=float, default=2.0, help='Seconds a fresh solve takes')
+    parser.add_argument('--clearance-ttl', type=float, default=3600, help='Seconds a cf_clearance stays valid')
+    args = parser.parse_args()
+
+    archive = SnapshotArchive()
+    dates = [d for d in archive.dates() if archive.entry(d)['size']]
+    page = archive.read(dates[-1]) if dates else FALLBACK_PAGE
+
+    solver = Solver(args.solve_delay, args.clearance_ttl)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(solver, page))
+    print(f"Stand-in FlareSolverr on http://127.0.0.1:{args.port}/v1, page on http://127.0.0.1:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
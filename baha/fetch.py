@@ -1,35 +1,140 @@
 """
-Fetch ani.gamer.com.tw page source via FlareSolverr (bypasses CF challenge).
+Fetch ani.gamer.com.tw (and the other pages in targets.json) via FlareSolverr (bypasses CF challenge).
 Results are logged to README.md in this directory.
 
-Requires FlareSolverr running on localhost:8191.
+Targets are fetched concurrently, at most `host_limits` requests at a time
+per host. The cf_clearance cookies and user agent of the last solve of each
+host are archived; a page is first fetched directly with them, and only when
+Cloudflare rejects them is FlareSolverr asked to solve again, once per host,
+through a pool of named sessions so browsers (and clearance) are reused
+instead of started from scratch. Each page is archived and handed to the
+in-process parser registered under its `parser` name.
+
+Requires FlareSolverr running on localhost:8191 (or dev_flaresolverr.py for
+local testing: FLARESOLVERR_URL=http://localhost:8191/v1 BAHA_URL=http://localhost:8191/).
+
+    python fetch.py                      # all targets
+    python fetch.py --only ani           # just some of them
 """
 
+import argparse
 import json
 import os
+import queue
+import re
 import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
+
+import build_schedule
+import schedule_history
+from archive import SnapshotArchive
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 README_PATH = os.path.join(SCRIPT_DIR, 'README.md')
-SOURCE_DIR = os.path.join(SCRIPT_DIR, 'source')
+CONFIG_PATH = os.path.join(SCRIPT_DIR, 'targets.json')
 
 FLARESOLVERR_URL = os.environ.get('FLARESOLVERR_URL', 'http://localhost:8191/v1')
-TARGET_URL = 'https://ani.gamer.com.tw/'
+FLARESOLVERR_SESSION = os.environ.get('FLARESOLVERR_SESSION', 'baha')
+DIRECT_TIMEOUT = 30
+DEFAULT_HOST_LIMIT = 2
+MIN_PAGE_SIZE = 5000
 
 today = datetime.now().strftime('%Y-%m-%d')
 now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+PARSERS = {}
+
+
+def register_parser(name):
+    """Register func(html, date, archive) as the parser for targets with `"parser": name`."""
+    def decorator(func):
+        PARSERS[name] = func
+        return func
+    return decorator
+
+
+@register_parser('schedule')
+def parse_schedule(html, date, archive):
+    """ani.gamer.com.tw home page: rebuild schedule.json/html and schedule_history.json."""
+    build_schedule.build(html, date)
+    schedule_history.refresh(archive)
+
+
+def load_config(path=CONFIG_PATH):
+    """Targets config; BAHA_URL overrides the first target's URL."""
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if os.environ.get('BAHA_URL'):
+        config['targets'][0]['url'] = os.environ['BAHA_URL']
+    for target in config['targets']:
+        target.setdefault('kind', target['name'])
+        target.setdefault('parser', None)
+        if target['parser'] and target['parser'] not in PARSERS:
+            raise ValueError(f"Unknown parser {target['parser']!r} for target {target['name']}")
+    return config
+
+
+def host_of(url):
+    return urlsplit(url).hostname
+
+
+def is_challenge(html, title=''):
+    return "challenge" in html[:3000].lower() or "just a moment" in title.lower()
+
+
+def fetch_direct(url, clearance):
+    """Fetch `url` with saved cf_clearance cookies; returns (html, status) or None if missing/rejected."""
+    if not clearance or not clearance.get('user_agent'):
+        return None
+    cookies = {c['name']: c['value'] for c in clearance.get('cookies', [])}
+    if 'cf_clearance' not in cookies:
+        return None
+
+    print(f"Direct fetch with saved clearance: {url}")
+    try:
+        resp = requests.get(url, headers={'User-Agent': clearance['user_agent']},
+                            cookies=cookies, timeout=DIRECT_TIMEOUT)
+    except Exception as e:
+        print(f"Direct fetch failed: {e}")
+        return None
+    resp.encoding = 'utf-8'
+    if resp.status_code != 200 or is_challenge(resp.text):
+        print(f"Saved clearance rejected for {url} (HTTP {resp.status_code}), falling back to FlareSolverr")
+        return None
+    return resp.text, resp.status_code
+
+
+def ensure_session(name):
+    """Create the named FlareSolverr session unless it exists; returns its name, or None to solve without one."""
+    try:
+        data = requests.post(FLARESOLVERR_URL, json={"cmd": "sessions.list"}, timeout=10).json()
+        if name in data.get('sessions', []):
+            return name
+        data = requests.post(FLARESOLVERR_URL, json={"cmd": "sessions.create", "session": name}, timeout=90).json()
+    except Exception as e:
+        print(f"FlareSolverr session unavailable: {e}")
+        return None
+    if data.get('status') != 'ok':
+        print(f"FlareSolverr session not created: {data.get('message', '')}")
+        return None
+    return name
+
 
-def fetch_via_flaresolverr():
+def fetch_via_flaresolverr(url, session=None):
     """Send request to FlareSolverr and get solved page."""
-    print(f"[1/2] Sending request to FlareSolverr: {TARGET_URL}")
+    print(f"Sending request to FlareSolverr: {url}" + (f" (session {session})" if session else ""))
     payload = {
         "cmd": "request.get",
-        "url": TARGET_URL,
+        "url": url,
         "maxTimeout": 60000,
     }
+    if session:
+        payload["session"] = session
 
     try:
         resp = requests.post(FLARESOLVERR_URL, json=payload, timeout=90)
@@ -49,59 +154,140 @@ def fetch_via_flaresolverr():
     return html, status, {'cookies': cookies, 'user_agent': user_agent}
 
 
-def main():
-    os.makedirs(SOURCE_DIR, exist_ok=True)
+class SolverPool:
+    """Named FlareSolverr sessions shared by all targets; each solve borrows one."""
+
+    def __init__(self, size, prefix=FLARESOLVERR_SESSION):
+        self.free = queue.Queue()
+        for i in range(max(1, size)):
+            self.free.put(prefix if i == 0 else f"{prefix}-{i + 1}")
+        self.ready = set()
 
-    html, status, meta = fetch_via_flaresolverr()
+    def solve(self, url):
+        name = self.free.get()
+        try:
+            if name not in self.ready and ensure_session(name):
+                self.ready.add(name)
+            return fetch_via_flaresolverr(url, name if name in self.ready else None)
+        finally:
+            self.free.put(name)
+
+
+class HostGate:
+    """Per-host request limit and the host's current clearance, re-solved by one target at a time."""
+
+    def __init__(self, limit, clearance):
+        self.slots = threading.Semaphore(limit)
+        self.solve_lock = threading.Lock()
+        self.clearance = clearance
+
+
+def fetch_target(url, gate, pool):
+    """Returns (html, status, clearance); clearance is None unless a new one was solved."""
+    tried = gate.clearance
+    with gate.slots:
+        direct = fetch_direct(url, tried)
+    if direct:
+        return direct[0], direct[1], None
+    with gate.solve_lock:
+        if gate.clearance is not tried:
+            # Another target of this host solved while we waited
+            with gate.slots:
+                direct = fetch_direct(url, gate.clearance)
+            if direct:
+                return direct[0], direct[1], None
+        with gate.slots:
+            html, status, clearance = pool.solve(url)
+        if clearance and clearance.get('cookies'):
+            gate.clearance = clearance
+        return html, status, clearance
+
+
+def load_clearance(archive, host):
+    kind = f"clearance:{host}"
+    dates = archive.dates(kind)
+    return archive.read_json(dates[-1], kind) if dates else None
+
+
+def run_target(target, gate, pool, archive, lock):
+    """Fetch, archive and parse one target; returns its result record."""
+    start = time.perf_counter()
+    html, status, clearance = fetch_target(target['url'], gate, pool)
 
     if html is None:
-        print(f"FAIL: {status}")
+        print(f"[{target['name']}] FAIL: {status}")
         html = ""
-        html_len = 0
         title = ""
         cf_blocked = True
     else:
-        html_len = len(html)
         # Extract title from HTML
-        import re
         title_match = re.search(r'<title[^>]*>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
         title = title_match.group(1).strip() if title_match else ""
-        cf_blocked = "challenge" in html[:3000].lower() or "just a moment" in title.lower()
-
-    print(f"[2/2] Result: status={status}, html={html_len:,} bytes, title={title[:60]}, cf_blocked={cf_blocked}")
-
-    # Save source
-    source_file = os.path.join(SOURCE_DIR, f"{today}.html")
-    with open(source_file, 'w', encoding='utf-8') as f:
-        f.write(html)
-    print(f"Source saved to {source_file}")
-
-    # Save cookies if available
-    if meta and meta.get('cookies'):
-        cookie_file = os.path.join(SOURCE_DIR, f"{today}_cookies.json")
-        with open(cookie_file, 'w') as f:
-            json.dump(meta['cookies'], f, indent=2)
-
-    # Update README
-    success = not cf_blocked and html_len > 5000
-    status_icon = "PASS" if success else "FAIL"
-    status_clean = str(status).split('\n')[0][:80]
-    title_clean = title.replace('\n', ' ')[:50]
-    entry = f"| {today} | {status_icon} | {status_clean} | {html_len:,} | {title_clean} |"
-
-    update_readme(now_str, entry, success, status, html_len, title, source_file)
-
-    if success:
-        print(f"SUCCESS: Got {html_len:,} bytes, title: {title[:60]}")
-        # Auto-build schedule
-        try:
-            import subprocess
-            subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'build_schedule.py')], check=True)
-            print("Schedule built successfully")
-        except Exception as e:
-            print(f"Schedule build failed: {e}")
-    else:
-        print(f"FAIL: {html_len:,} bytes, title: {title[:60]}")
+        cf_blocked = is_challenge(html, title)
+    success = not cf_blocked and len(html) > target.get('min_size', MIN_PAGE_SIZE)
+
+    with lock:
+        # Save source (and a new clearance if one was solved) to the archive
+        sha1 = archive.put(today, html, target['kind'])
+        if clearance and clearance.get('cookies'):
+            archive.put(today, json.dumps(clearance, indent=2), f"clearance:{host_of(target['url'])}")
+        archive.save()
+        stored = archive.entry(today, target['kind'])
+        source_file = os.path.relpath(archive.blob_path(sha1, stored['codec']), SCRIPT_DIR).replace(os.sep, '/')
+
+        if success and target['parser']:
+            try:
+                PARSERS[target['parser']](html, today, archive)
+            except Exception as e:
+                print(f"[{target['name']}] Parser {target['parser']} failed: {e}")
+
+    seconds = time.perf_counter() - start
+    print(f"[{target['name']}] status={status}, html={len(html):,} bytes, title={title[:60]}, "
+          f"cf_blocked={cf_blocked}, {seconds:.1f}s -> {source_file}")
+    return {'name': target['name'], 'status': status, 'html_len': len(html), 'title': title,
+            'success': success, 'source_file': source_file, 'seconds': seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch the configured pages through FlareSolverr")
+    parser.add_argument('--config', default=CONFIG_PATH, help='Targets config (default: targets.json)')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='Fetch only these targets')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    targets = [t for t in config['targets'] if not args.only or t['name'] in args.only]
+    archive = SnapshotArchive()
+    pool = SolverPool(config.get('solver_sessions', 1))
+    limits = config.get('host_limits', {})
+    gates = {}
+    for target in targets:
+        host = host_of(target['url'])
+        if host not in gates:
+            gates[host] = HostGate(limits.get(host, config.get('default_host_limit', DEFAULT_HOST_LIMIT)),
+                                   load_clearance(archive, host))
+
+    start = time.perf_counter()
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+        results = list(executor.map(
+            lambda t: run_target(t, gates[host_of(t['url'])], pool, archive, lock), targets))
+    wall = time.perf_counter() - start
+    print(f"Fetched {sum(r['success'] for r in results)}/{len(results)} targets in {wall:.1f}s "
+          f"(sum of targets {sum(r['seconds'] for r in results):.1f}s)")
+
+    # README tracks the main page (first target in the config)
+    main_result = next((r for r in results if r['name'] == config['targets'][0]['name']), None)
+    if main_result:
+        status_icon = "PASS" if main_result['success'] else "FAIL"
+        status_clean = str(main_result['status']).split('\n')[0][:80]
+        title_clean = main_result['title'].replace('\n', ' ')[:50]
+        entry = f"| {today} | {status_icon} | {status_clean} | {main_result['html_len']:,} | {title_clean} |"
+        update_readme(now_str, entry, main_result['success'], main_result['status'], main_result['html_len'],
+                      main_result['title'], main_result['source_file'])
+
+    failed = [r['name'] for r in results if not r['success']]
+    if failed:
+        print(f"FAIL: {', '.join(failed)}")
         sys.exit(1)
 
 
@@ -141,7 +327,7 @@ def update_readme(now_str, entry, success, status, html_len, title, source_file)
             new_lines.append(f"- HTTP Status: {status}")
             new_lines.append(f"- 页面大小: {html_len:,} bytes")
             new_lines.append(f"- 标题: {title[:80]}")
-            new_lines.append(f"- 源码: [source/{today}.html](source/{today}.html)")
+            new_lines.append(f"- 源码: [{source_file}]({source_file})")
             new_lines.append("")
             continue
         if in_status and line.startswith("## "):
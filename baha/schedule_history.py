@@ -0,0 +1,180 @@
+"""Incremental index of every baha schedule snapshot, with timeline queries.
+
+Each archived snapshot is parsed once: parsed schedules are stored in
+schedule_index.json keyed by the SHA-1 of the snapshot content, which the
+archive index already records, so an update only reads and parses the new
+snapshots. From the index:
+
+    python schedule_history.py                    # update index, write schedule_history.json
+    python schedule_history.py --title 婚姻劇毒     # one title's slots over time
+    python schedule_history.py --diff 2026-06-10 2026-07-03   # per-day changes (default: last two)
+
+schedule_history.json is the compact site version: the snapshot dates and,
+for each title, the runs of snapshots during which its slots stayed the same.
+"""
+
+import argparse
+import json
+import os
+
+from archive import SnapshotArchive
+from build_schedule import DAYS, extract_schedule
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_PATH = os.path.join(SCRIPT_DIR, 'schedule_index.json')
+HISTORY_JSON = os.path.join(SCRIPT_DIR, 'schedule_history.json')
+
+
+def load_index(path=INDEX_PATH):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'snapshots': {}, 'schedules': {}}
+
+
+def save_index(index, path=INDEX_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+
+def update_index(index, archive=None):
+    """Index snapshots not seen before; returns (dates indexed, snapshots parsed).
+
+    `snapshots` maps snapshot date -> {sha1, size}; `schedules` maps sha1 ->
+    parsed schedule, so identical snapshots share one parse.
+    """
+    archive = archive or SnapshotArchive()
+    indexed = 0
+    parsed = 0
+    for date in archive.dates():
+        entry = archive.entry(date)
+        sha1 = entry['sha1']
+        known = index['snapshots'].get(date)
+        if known and known['sha1'] == sha1:
+            continue
+        if sha1 not in index['schedules']:
+            with archive.open(date) as f:
+                index['schedules'][sha1] = extract_schedule(f)
+            parsed += 1
+        index['snapshots'][date] = {'sha1': sha1, 'size': entry['size']}
+        indexed += 1
+    return indexed, parsed
+
+
+def snapshots(index):
+    """(date, schedule) pairs oldest first, leaving out failed fetches with no schedule."""
+    result = []
+    for date in sorted(index['snapshots']):
+        schedule = index['schedules'][index['snapshots'][date]['sha1']]
+        if schedule:
+            result.append((date, schedule))
+    return result
+
+
+def title_slots(schedule):
+    """Map title -> sorted [day, time] slots in one schedule."""
+    slots = {}
+    for day in DAYS:
+        for entry in schedule.get(day, []):
+            slots.setdefault(entry['name'], []).append([day, entry['time']])
+    for value in slots.values():
+        value.sort(key=lambda s: (DAYS.index(s[0]), s[1]))
+    return slots
+
+
+def timelines(index):
+    """Map title -> [[first_date, last_date, slots], ...], one run per unchanged stretch of snapshots.
+
+    A title missing from a snapshot ends its current run, so gaps show when a
+    show was dropped and when it came back.
+    """
+    result = {}
+    previous = None
+    for date, schedule in snapshots(index):
+        for title, slots in title_slots(schedule).items():
+            runs = result.setdefault(title, [])
+            if runs and runs[-1][1] == previous and runs[-1][2] == slots:
+                runs[-1][1] = date
+            else:
+                runs.append([date, date, slots])
+        previous = date
+    return result
+
+
+def title_history(index, title):
+    """Slot history of one title: [[first_date, last_date, slots], ...]."""
+    return timelines(index).get(title, [])
+
+
+def day_diff(index, old_date, new_date):
+    """Per-day changes between two snapshots: {day: {added, removed, moved}}.
+
+    `moved` lists [title, old_time, new_time] for titles that stayed on the
+    day at a different time; a title that changed day shows up as removed
+    from one day and added to another.
+    """
+    old = index['schedules'][index['snapshots'][old_date]['sha1']]
+    new = index['schedules'][index['snapshots'][new_date]['sha1']]
+    diff = {}
+    for day in DAYS:
+        before = {e['name']: e['time'] for e in old.get(day, [])}
+        after = {e['name']: e['time'] for e in new.get(day, [])}
+        changes = {
+            'added': sorted(t for t in after if t not in before),
+            'removed': sorted(t for t in before if t not in after),
+            'moved': sorted([t, before[t], after[t]] for t in after if t in before and before[t] != after[t]),
+        }
+        if any(changes.values()):
+            diff[day] = changes
+    return diff
+
+
+def write_history_json(index, path=HISTORY_JSON):
+    """Write the compact site timeline file."""
+    history = {
+        'snapshots': [date for date, _ in snapshots(index)],
+        'titles': timelines(index),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, separators=(',', ':'))
+    return history
+
+
+def refresh(archive=None):
+    """Index new snapshots and rewrite schedule_history.json; returns the number parsed."""
+    index = load_index()
+    indexed, parsed = update_index(index, archive)
+    if indexed:
+        save_index(index)
+    history = write_history_json(index)
+    print(f"History JSON saved: {HISTORY_JSON} ({len(history['titles'])} titles, {parsed} snapshots newly parsed)")
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index baha schedule snapshots and query their history")
+    parser.add_argument('--title', help='Print the slot history of one title')
+    parser.add_argument('--diff', nargs='*', metavar='DATE',
+                        help='Per-day changes between two snapshot dates (default: the last two)')
+    args = parser.parse_args()
+
+    index = load_index()
+    indexed, parsed = update_index(index)
+    if indexed:
+        save_index(index)
+    dates = [date for date, _ in snapshots(index)]
+    print(f"Index: {len(index['snapshots'])} snapshots, {len(index['schedules'])} unique, {parsed} newly parsed")
+
+    if args.title:
+        for first, last, slots in title_history(index, args.title):
+            print(f"{first} .. {last}: {', '.join(f'{d} {t}' for d, t in slots)}")
+    elif args.diff is not None:
+        old_date, new_date = args.diff if len(args.diff) == 2 else dates[-2:]
+        print(json.dumps(day_diff(index, old_date, new_date), ensure_ascii=False, indent=2))
+    else:
+        history = write_history_json(index)
+        print(f"History JSON saved: {HISTORY_JSON} ({len(history['titles'])} titles over {len(dates)} snapshots)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,35 @@
 """
 Compress changed cover images to AVIF format for the gallery site.
 
-Reads data.json to find ISBNs whose MD5 changed today (or on a specified date),
-downloads the cover, compresses to AVIF 800px width, and saves to site/img/.
-
-Also generates site/data.json with only the ISBNs that have compressed images.
+Reads the cover history from history.db (via HistoryStore) to find ISBNs
+whose MD5 changed today (or on a specified date), downloads the cover and, from a single decode, encodes 200/400/800px wide AVIF
+variants plus WebP fallbacks into site/img/ for srcset. Images are
+content-addressed by cover MD5 (site/img/ab/abcd...-400.avif), so a
+cover shared by several ISBNs is downloaded and encoded once. Covers that
+run.py already encoded from the downloaded TIF are skipped, and known
+placeholder covers are never downloaded.
+
+Also generates site/data.json with only the ISBNs and history entries that have
+compressed images; each entry points at its image file and carries its
+dimensions and a tiny inline placeholder. Image paths never change content,
+so they are safe to cache forever; --gc prunes versions outside the retention
+policy.
 """
 
 import json
 import os
-import sys
+import base64
 import hashlib
+import argparse
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
 import requests
 
+from history import DB_PATH, HistoryStore
+
 try:
     from PIL import Image
     import pillow_avif
@@ -32,16 +47,27 @@ data_file_path = os.path.join(SCRIPT_DIR, 'data.json')
 site_dir = os.path.join(SCRIPT_DIR, 'site')
 img_dir = os.path.join(site_dir, 'img')
 site_data_path = os.path.join(site_dir, 'data.json')
+shard_dir = os.path.join(site_dir, 'data')
 
-IMG_WIDTH = 800
+VARIANT_WIDTHS = (200, 400, 800)    # Gallery tiles are ~120-250 CSS px wide
+FORMATS = ('avif', 'webp') if HAS_AVIF else ('webp',)   # WebP is the <picture> fallback
+QUALITY = {'avif': 50, 'webp': 70}  # Fixed settings; --target-ssim searches the primary format's instead
+AVIF_SPEED = 6
 
+# Adaptive mode: lowest quality whose preview still reaches the SSIM target
+ADAPTIVE_QUALITY_RANGE = (20, 80)
+DEFAULT_TARGET_SSIM = 0.95     # --benchmark default
+PREVIEW_WIDTH = 200
+PREVIEW_SPEED = 8
+SSIM_BLOCK = 8
+IO_WORKERS = 16
+LQIP_WIDTH = 8      # Inline placeholder: an 8px-wide WebP, ~50-90 bytes
 
-def get_subdir(isbn):
-    """Distribute files into subdirs 000-999 to avoid single-folder limits."""
-    h = 0
-    for c in isbn:
-        h = (h * 31 + ord(c)) & 0x7fffffff
-    return str(h % 1000).zfill(3)
+# "Cover coming soon" placeholders shared by many unrelated ISBNs
+PLACEHOLDER_MD5S = {
+    'ddd2341f5bad97bd3fdb12a57e0e4b2f',
+    'e3aa0f3df52de64203ece91b9675b5e5',
+}
 
 
 def find_changed_isbns(data, target_date=None):
@@ -67,38 +93,138 @@ def find_all_isbns_with_dates(data):
     return result
 
 
-def download_and_compress(isbn, target_date=None):
-    """Download cover image and compress to AVIF."""
-    if target_date is None:
-        target_date = today
-
-    subdir = get_subdir(isbn)
-    out_dir = os.path.join(img_dir, subdir)
-    os.makedirs(out_dir, exist_ok=True)
+def find_changed_covers(store, dates, visual_only=False):
+    """Map cover MD5 -> one ISBN serving it, for ISBNs that changed on any of `dates`.
+
+    Only each ISBN's latest MD5 is used (that is what the server returns now),
+    and placeholder covers are skipped, as are ISBNs still in the crawl backlog:
+    run.py downloads those a few per run (--crawl-downloads). With
+    `visual_only`, byte-only changes (same picture re-encoded, see
+    HistoryStore.change_kind) are skipped too.
+    """
+    backlog = store.crawl_backlog()
+    covers = {}
+    for isbn in sorted(store.isbns_changed_on(dates)):
+        md5 = store.latest(isbn)
+        if isbn in backlog or md5 in PLACEHOLDER_MD5S or (visual_only and store.change_kind(isbn) == 'bytes'):
+            continue
+        covers.setdefault(md5, isbn)
+    return covers
+
+
+def get_output_path(md5, width, fmt):
+    """Return the content-addressed site/img/ path of one variant of a cover MD5."""
+    return os.path.join(img_dir, md5[:2], f'{md5}-{width}.{fmt}')
+
+
+def variant_widths(width):
+    """Target widths for a source `width` px wide; never upscales."""
+    return sorted({w for w in VARIANT_WIDTHS if w < width} | {min(width, VARIANT_WIDTHS[-1])})
+
+
+def dhash(src):
+    """64-bit difference hash (hex) of an image file or raw bytes.
+
+    Compares horizontally adjacent pixels of a 9x8 greyscale thumbnail, so it
+    survives re-encoding and resizing but not a different picture.
+    """
+    with Image.open(BytesIO(src) if isinstance(src, bytes) else src) as img:
+        pixels = img.convert('L').resize((9, 8), Image.LANCZOS).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f'{bits:016x}'
+
+
+def placeholder_uri(img):
+    """Tiny blurred stand-in for `img` as a data: URI, shown until the real image loads."""
+    height = max(1, round(LQIP_WIDTH * img.height / img.width))
+    thumb = img.convert('RGB').resize((LQIP_WIDTH, height), Image.BOX)
+    buf = BytesIO()
+    thumb.save(buf, 'WEBP', quality=20)
+    return 'data:image/webp;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def image_info(path, md5=None, isbn=None, img=None, lqip=None):
+    """Manifest record for an encoded image file; `img` is the encoded image if still in memory."""
+    if img is None:
+        with Image.open(path) as opened:
+            return image_info(path, md5, isbn, opened, lqip)
+    return {
+        'path': os.path.relpath(path, img_dir).replace(os.sep, '/'),
+        'md5': md5,
+        'isbn': isbn,
+        'bytes': os.path.getsize(path),
+        'width': img.width,
+        'height': img.height,
+        'lqip': lqip or placeholder_uri(img),
+    }
+
+
+def save_image(img, dest, fmt, quality, speed=AVIF_SPEED):
+    """Encode `img` to a path or file object as AVIF or WebP."""
+    if fmt == 'avif':
+        img.save(dest, 'AVIF', quality=quality, speed=speed)
+    else:
+        img.save(dest, 'WEBP', quality=quality)
+
+
+def ssim(a, b):
+    """Mean SSIM over SSIM_BLOCK-sized tiles of two same-size images, compared in greyscale."""
+    a, b = a.convert('L'), b.convert('L')
+    width, height = a.size
+    pa, pb = a.tobytes(), b.tobytes()
+    n = SSIM_BLOCK * SSIM_BLOCK
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    total = 0.0
+    blocks = 0
+    for y in range(0, height - SSIM_BLOCK + 1, SSIM_BLOCK):
+        for x in range(0, width - SSIM_BLOCK + 1, SSIM_BLOCK):
+            xs, ys = [], []
+            for row in range(y * width + x, (y + SSIM_BLOCK) * width + x, width):
+                xs += pa[row:row + SSIM_BLOCK]
+                ys += pb[row:row + SSIM_BLOCK]
+            mx, my = sum(xs) / n, sum(ys) / n
+            vx = sum(v * v for v in xs) / n - mx * mx
+            vy = sum(v * v for v in ys) / n - my * my
+            cov = sum(map(int.__mul__, xs, ys)) / n - mx * my
+            total += ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+            blocks += 1
+    return total / blocks if blocks else 1.0
+
+
+def adaptive_quality(img, fmt, target_ssim):
+    """Binary-search the lowest `fmt` quality whose encode of a PREVIEW_WIDTH preview reaches `target_ssim`."""
+    width = min(PREVIEW_WIDTH, img.width)
+    preview = img.resize((width, max(1, int(img.height * width / img.width))), Image.BOX)
+    lo, hi = ADAPTIVE_QUALITY_RANGE
+    best = hi
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        buf = BytesIO()
+        save_image(preview, buf, fmt, quality, speed=PREVIEW_SPEED)
+        buf.seek(0)
+        with Image.open(buf) as decoded:
+            score = ssim(preview, decoded)
+        if score >= target_ssim:
+            best, hi = quality, quality - 1
+        else:
+            lo = quality + 1
+    return best
 
-    ext = 'avif' if HAS_AVIF else 'webp'
-    out_path = os.path.join(out_dir, f'{isbn}.{ext}')
 
-    # Skip if already exists
-    if os.path.exists(out_path):
-        return True
+def encode_cover(md5, src, isbn=None, target_ssim=None):
+    """Decode a cover (file path or raw bytes) once and encode every width/format variant under its MD5.
 
-    # Download cover at higher resolution for quality
-    cover_url = f"https://images2.penguinrandomhouse.com/cover/{isbn}?width=1600"
+    With `target_ssim`, the primary format's quality is chosen per cover by
+    adaptive_quality() instead of the fixed QUALITY setting. Runs in worker
+    processes, so it only touches its own output files. Returns the manifest
+    records of all variants, or None on failure.
+    """
     try:
-        resp = requests.get(cover_url, timeout=30)
-        if resp.status_code != 200:
-            print(f"  [WARN] Failed to download {isbn}: HTTP {resp.status_code}")
-            return False
-
-        img = Image.open(BytesIO(resp.content))
-
-        # Resize to target width maintaining aspect ratio
-        w, h = img.size
-        if w > IMG_WIDTH:
-            ratio = IMG_WIDTH / w
-            new_h = int(h * ratio)
-            img = img.resize((IMG_WIDTH, new_h), Image.LANCZOS)
+        img = Image.open(BytesIO(src) if isinstance(src, bytes) else src)
+        img.load()
 
         # Convert to RGB if necessary (AVIF doesn't support CMYK/palette)
         if img.mode in ('CMYK', 'P', 'LA'):
@@ -109,94 +235,384 @@ def download_and_compress(isbn, target_date=None):
         elif img.mode != 'RGB':
             img = img.convert('RGB')
 
-        # Save as AVIF or WebP
-        if HAS_AVIF:
-            img.save(out_path, 'AVIF', quality=50, speed=6)
-        else:
-            img.save(out_path, 'WEBP', quality=70)
-
-        size_kb = os.path.getsize(out_path) / 1024
-        print(f"  {isbn} -> {subdir}/{isbn}.{ext} ({size_kb:.0f} KB)")
-        return True
+        quality = dict(QUALITY)
+        if target_ssim:
+            quality[FORMATS[0]] = adaptive_quality(img, FORMATS[0], target_ssim)
+
+        records = []
+        lqip = None
+        for width in sorted(variant_widths(img.width), reverse=True):
+            # Resize from the full decode, maintaining aspect ratio
+            resized = img if width == img.width else img.resize((width, int(img.height * width / img.width)), Image.LANCZOS)
+            lqip = lqip or placeholder_uri(resized)
+            for fmt in FORMATS:
+                out_path = get_output_path(md5, width, fmt)
+                if not os.path.exists(out_path):
+                    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                    save_image(resized, out_path, fmt, quality[fmt])
+                records.append(image_info(out_path, md5, isbn, resized, lqip))
+
+        total = sum(r['bytes'] for r in records)
+        print(f"  {md5} -> {len(records)} variants ({total / 1024:.0f} KB, {FORMATS[0]} q{quality[FORMATS[0]]})")
+        return records
 
     except Exception as e:
-        print(f"  [ERROR] {isbn}: {e}")
-        return False
+        print(f"  [ERROR] {md5}: {e}")
+        return None
 
 
-def generate_site_data(data):
-    """Generate site/data.json with all ISBNs that have images."""
+def fetch_cover(isbn):
+    """Download the width=1600 source cover; returns the bytes or None."""
+    cover_url = f"https://images2.penguinrandomhouse.com/cover/{isbn}?width=1600"
+    try:
+        resp = requests.get(cover_url, timeout=30)
+        if resp.status_code != 200:
+            print(f"  [WARN] Failed to download {isbn}: HTTP {resp.status_code}")
+            return None
+        return resp.content
+    except Exception as e:
+        print(f"  [ERROR] {isbn}: {e}")
+        return None
+
+
+def download_and_compress(md5, isbn, target_ssim=None):
+    """Download the cover `md5` (as served for `isbn`) and encode its variants; returns their manifest records."""
+    content = fetch_cover(isbn)
+    if content is None:
+        return None
+    return encode_cover(md5, content, isbn, target_ssim)
+
+
+def compress_all(covers, jobs=None, record=None, target_ssim=None):
+    """Download and encode covers ({md5: isbn}), reporting progress every 100; returns the success count.
+
+    `record(info)` is called (serialised) with the manifest record of each
+    variant as soon as its cover's encode finishes. With jobs > 1, an I/O thread pool downloads
+    sources and hands the bytes to a process pool that decodes, resizes and
+    encodes on every core. At most 2 * jobs sources are held in memory while
+    waiting for a free encoder.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    total = len(covers)
+    counts = {'done': 0, 'success': 0}
+    lock = threading.Lock()
+
+    def finish(records):
+        with lock:
+            counts['done'] += 1
+            if records:
+                counts['success'] += 1
+                for info in records if record else ():
+                    record(info)
+            if counts['done'] % 100 == 0:
+                print(f"  Progress: {counts['done']}/{total}")
+
+    if jobs == 1:
+        for md5, isbn in covers.items():
+            finish(download_and_compress(md5, isbn, target_ssim))
+        return counts['success']
+
+    slots = threading.BoundedSemaphore(jobs * 2)
+
+    def on_encoded(future):
+        slots.release()
+        finish(future.result() if future.exception() is None else None)
+
+    with ProcessPoolExecutor(max_workers=jobs) as cpu_pool, ThreadPoolExecutor(max_workers=IO_WORKERS) as io_pool:
+        def fetch_and_submit(md5, isbn):
+            content = fetch_cover(isbn)
+            if content is None:
+                slots.release()
+                finish(None)
+                return
+            try:
+                cpu_pool.submit(encode_cover, md5, content, isbn, target_ssim).add_done_callback(on_encoded)
+            except Exception as e:
+                print(f"  [ERROR] {isbn}: {e}")
+                slots.release()
+                finish(None)
+
+        for md5, isbn in covers.items():
+            slots.acquire()
+            io_pool.submit(fetch_and_submit, md5, isbn)
+        io_pool.shutdown(wait=True)
+        cpu_pool.shutdown(wait=True)
+
+    return counts['success']
+
+
+def benchmark(paths, target_ssim):
+    """Compare fixed-quality and adaptive encodes of source images in memory; prints bytes, SSIM and time per image.
+
+    Each source is resized to the largest variant width and encoded in the
+    primary format with QUALITY, then with the quality adaptive_quality()
+    picks for `target_ssim` (search time included). Nothing is written.
+    """
+    fmt = FORMATS[0]
+    totals = {'fixed': 0, 'adaptive': 0, 'fixed_time': 0.0, 'adaptive_time': 0.0}
+    print(f"{'image':<40} {'fixed KB':>9} {'ssim':>6} {'time':>6}  {'adapt KB':>9} {'q':>3} {'ssim':>6} {'time':>6}  {'saved':>6}")
+    for path in paths:
+        with Image.open(path) as src:
+            img = src.convert('RGB')
+        width = min(VARIANT_WIDTHS[-1], img.width)
+        img = img.resize((width, int(img.height * width / img.width)), Image.LANCZOS)
+
+        results = {}
+        for mode in ('fixed', 'adaptive'):
+            start = time.monotonic()
+            quality = adaptive_quality(img, fmt, target_ssim) if mode == 'adaptive' else QUALITY[fmt]
+            buf = BytesIO()
+            save_image(img, buf, fmt, quality)
+            elapsed = time.monotonic() - start
+            buf.seek(0)
+            with Image.open(buf) as decoded:
+                score = ssim(img, decoded)
+            results[mode] = (len(buf.getvalue()), quality, score, elapsed)
+            totals[mode] += results[mode][0]
+            totals[mode + '_time'] += elapsed
+
+        (fb, _, fs, ft), (ab, aq, as_, at) = results['fixed'], results['adaptive']
+        print(f"{os.path.basename(path)[:40]:<40} {fb / 1024:>9.1f} {fs:>6.3f} {ft:>5.2f}s  "
+              f"{ab / 1024:>9.1f} {aq:>3} {as_:>6.3f} {at:>5.2f}s  {(1 - ab / fb) * 100:>5.1f}%")
+
+    if paths:
+        n = len(paths)
+        print(f"Total ({n} images, {fmt}, target SSIM {target_ssim}): "
+              f"fixed q{QUALITY[fmt]} {totals['fixed'] / 1024:.0f} KB in {totals['fixed_time'] / n:.2f}s/image, "
+              f"adaptive {totals['adaptive'] / 1024:.0f} KB in {totals['adaptive_time'] / n:.2f}s/image "
+              f"({(1 - totals['adaptive'] / totals['fixed']) * 100:.1f}% bytes saved)")
+
+
+def verify_manifest(store):
+    """Reconcile the image manifest with site/img/ on disk.
+
+    Drops records whose file is gone, adds untracked files (content-addressed
+    names become versions, other names legacy per-ISBN images) and refreshes
+    records whose size changed or that predate placeholders.
+    """
+    records = {r['path']: r for r in store.images()}
+    on_disk = {}
+    for root, dirs, files in os.walk(img_dir):
+        for f in files:
+            if f.endswith(('.avif', '.webp')):
+                path = os.path.join(root, f)
+                on_disk[os.path.relpath(path, img_dir).replace(os.sep, '/')] = path
+
+    missing = [p for p in records if p not in on_disk]
+    for rel in missing:
+        store.remove_image(rel)
+
+    added = 0
+    refreshed = 0
+    for rel, path in on_disk.items():
+        record = records.get(rel)
+        if record and record['bytes'] == os.path.getsize(path) and record['lqip']:
+            continue
+        name = os.path.splitext(os.path.basename(path))[0].split('-')[0]
+        if len(name) == 32:
+            info = image_info(path, md5=name, isbn=record['isbn'] if record else None)
+        else:
+            info = image_info(path, isbn=name)
+        store.record_image(info)
+        if record:
+            refreshed += 1
+        else:
+            added += 1
+    store.commit()
+    print(f"Verify: {len(on_disk)} files on disk, {len(missing)} missing records removed, "
+          f"{added} untracked files added, {refreshed} records refreshed")
+
+
+def generate_site_data(data, images):
+    """Generate site/data.json with all ISBNs that have images.
+
+    `images` is the image manifest, so no per-ISBN filesystem probes are
+    needed. Each history entry gets `img` (path under site/img/ of its largest
+    variant), its intrinsic `w`/`h`, an inline `lqip` placeholder and, for
+    content-addressed covers, `srcset` ({format: [[path, width], ...]}) from
+    the images for its MD5, falling back to the ISBN's legacy per-ISBN file.
+    Entries without an image (including placeholder covers) are left out
+    entirely, so the gallery never requests a file that does not exist.
+    """
     site_data = {}
-    ext = 'avif' if HAS_AVIF else 'webp'
+    variants = {}
+    for r in images:
+        if r['md5']:
+            variants.setdefault(r['md5'], []).append(r)
+    legacy = {r['isbn']: r for r in images if not r['md5']}
 
     for isbn, entries in data.items():
-        subdir = get_subdir(isbn)
-        img_path = os.path.join(img_dir, subdir, f'{isbn}.{ext}')
-        if os.path.exists(img_path):
-            site_data[isbn] = entries
+        site_entries = []
+        for entry in entries:
+            md5 = entry['md5']
+            if md5 in PLACEHOLDER_MD5S:
+                continue
+            if md5 in variants:
+                site_entries.append(variant_entry(entry, variants[md5]))
+            elif isbn in legacy:
+                image = legacy[isbn]
+                site_entries.append(dict(entry, img=image['path'], w=image['width'], h=image['height'],
+                                         lqip=image['lqip']))
+        if site_entries:
+            site_data[isbn] = site_entries
 
     with open(site_data_path, 'w') as f:
         json.dump(site_data, f, indent=2)
 
     print(f"Site data: {len(site_data)} ISBNs with images -> {site_data_path}")
+    write_site_shards(site_data)
     return site_data
 
 
-def main():
-    target_date = sys.argv[1] if len(sys.argv) > 1 else None
+def variant_entry(entry, records):
+    """Site data entry for a content-addressed cover from the manifest records of its variants."""
+    srcset = {}
+    for r in sorted(records, key=lambda r: r['width']):
+        srcset.setdefault(r['path'].rsplit('.', 1)[1], []).append([r['path'], r['width']])
+    # Largest variant of the preferred format is the default src and intrinsic size
+    fmt = 'avif' if 'avif' in srcset else 'webp'
+    largest = max((r for r in records if r['path'].endswith('.' + fmt)), key=lambda r: r['width'])
+    return dict(entry, img=largest['path'], w=largest['width'], h=largest['height'], lqip=largest['lqip'],
+                srcset={f: srcset[f] for f in sorted(srcset)})
+
+
+def write_site_shards(site_data):
+    """Write the gallery as per-month shards plus a small manifest, newest first.
+
+    site/data/manifest.json lists the shards; site/data/YYYY-MM.json maps each
+    date in that month to its [isbn, img, w, h, lqip] items, with a sixth
+    {format: [[path, width], ...]} element for covers that have srcset
+    variants. The gallery loads the newest shard first and fetches older ones
+    on scroll. Shards for months that no longer have images are removed.
+    """
+    months = {}
+    for isbn, entries in site_data.items():
+        for entry in entries:
+            day = months.setdefault(entry['date'][:7], {}).setdefault(entry['date'], {})
+            item = [isbn, entry['img'], entry['w'], entry['h'], entry['lqip']]
+            if 'srcset' in entry:
+                item.append(entry['srcset'])
+            day[isbn] = item
+
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for month in sorted(months, reverse=True):
+        dates = months[month]
+        shard = {date: [dates[date][isbn] for isbn in sorted(dates[date])]
+                 for date in sorted(dates, reverse=True)}
+        with open(os.path.join(shard_dir, f'{month}.json'), 'w') as f:
+            json.dump(shard, f, separators=(',', ':'))
+        shards.append({'month': month, 'file': f'data/{month}.json',
+                       'dates': len(shard), 'images': sum(len(v) for v in shard.values())})
+
+    for f in os.listdir(shard_dir):
+        if f.endswith('.json') and f != 'manifest.json' and f[:-5] not in months:
+            os.remove(os.path.join(shard_dir, f))
+
+    with open(os.path.join(shard_dir, 'manifest.json'), 'w') as f:
+        json.dump({'shards': shards}, f, indent=2)
+    print(f"Site shards: {len(shards)} months -> {shard_dir}")
+
+
+def collect_garbage(store, data, keep_versions=None):
+    """Delete gallery images that no retained history entry points at.
+
+    Retention policy: for every ISBN, the images of its newest `keep_versions`
+    non-placeholder versions are kept (all versions when None). A legacy
+    per-ISBN file is kept while any of those retained versions has no
+    content-addressed image of its own, since generate_site_data falls back
+    to it for them; it is removed otherwise, or when the ISBN is no longer in
+    data.json. Candidates come from the image manifest rather than a
+    directory walk.
+    """
+    retained = {}
+    for isbn, entries in data.items():
+        versions = list(dict.fromkeys(e['md5'] for e in reversed(entries) if e['md5'] not in PLACEHOLDER_MD5S))
+        retained[isbn] = versions[:keep_versions] if keep_versions else versions
+    keep = {md5 for versions in retained.values() for md5 in versions}
+
+    images = store.images()
+    have = {r['md5'] for r in images if r['md5']}
+    removed = 0
+    freed = 0
+    for record in images:
+        if record['md5']:
+            stale = record['md5'] not in keep
+        else:
+            stale = all(md5 in have for md5 in retained.get(record['isbn'], []))
+        if stale:
+            path = os.path.join(img_dir, record['path'])
+            if os.path.exists(path):
+                os.remove(path)
+            store.remove_image(record['path'])
+            freed += record['bytes']
+            removed += 1
+    store.commit()
+    print(f"GC: removed {removed} images ({freed / 1024:.0f} KB)")
+    return removed
+
 
-    if not os.path.exists(data_file_path):
-        print(f"Error: {data_file_path} not found")
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('date', nargs='?', help='Only compress covers changed on this date (YYYY-MM-DD)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Encoder processes (default: all cores, 1 = serial)')
+    parser.add_argument('--gc', action='store_true',
+                        help='Delete images no longer referenced by the retention policy')
+    parser.add_argument('--keep-versions', type=int, default=None,
+                        help='With --gc, keep images for only the newest N versions of each ISBN (default: all)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Reconcile the image manifest with the files in site/img/ first')
+    parser.add_argument('--changes', choices=['all', 'visual'], default='all',
+                        help='visual: skip covers whose change is byte-only (same perceptual hash)')
+    parser.add_argument('--target-ssim', type=float, default=None,
+                        help='Pick each cover\'s quality to reach this preview SSIM (e.g. 0.95) instead of fixed settings')
+    parser.add_argument('--benchmark', nargs='+', metavar='IMAGE',
+                        help='Compare fixed and --target-ssim encodes of local source images, then exit')
+    args = parser.parse_args()
+    target_date = args.date
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.target_ssim or DEFAULT_TARGET_SSIM)
         return
 
-    with open(data_file_path, 'r') as f:
-        data = json.load(f)
+    if not os.path.exists(DB_PATH) and not os.path.exists(data_file_path):
+        print(f"Error: neither {DB_PATH} nor {data_file_path} found")
+        return
 
     os.makedirs(img_dir, exist_ok=True)
 
-    if target_date:
-        # Compress only for a specific date
-        isbns = find_changed_isbns(data, target_date)
-        print(f"Compressing {len(isbns)} covers changed on {target_date}...")
-        for isbn in isbns:
-            download_and_compress(isbn, target_date)
-    else:
-        # Compress ALL changed covers (initial setup)
-        # Find the most recent date with changes
-        all_dates = set()
-        for entries in data.values():
-            for e in entries:
-                all_dates.add(e['date'])
-
-        latest_dates = sorted(all_dates)[-7:]  # Last 7 days
-        print(f"Compressing covers from last 7 days: {latest_dates}")
-
-        isbns_to_compress = set()
-        for isbn, entries in data.items():
-            for e in entries:
-                if e['date'] in latest_dates:
-                    isbns_to_compress.add(isbn)
-                    break
-
-        print(f"Total ISBNs to compress: {len(isbns_to_compress)}")
-        success = 0
-        for i, isbn in enumerate(sorted(isbns_to_compress)):
-            if download_and_compress(isbn):
-                success += 1
-            if (i + 1) % 100 == 0:
-                print(f"  Progress: {i + 1}/{len(isbns_to_compress)}")
-        print(f"Compressed: {success}/{len(isbns_to_compress)}")
-
-    # Generate site data
-    generate_site_data(data)
-
-    # Count total images
-    total_images = 0
-    for root, dirs, files in os.walk(img_dir):
-        for f in files:
-            if f.endswith(('.avif', '.webp')):
-                total_images += 1
-    print(f"Total images in site/img/: {total_images}")
+    with HistoryStore() as store:
+        if args.verify:
+            verify_manifest(store)
+
+        have = {r['md5'] for r in store.images() if r['md5']}
+        if target_date:
+            # Compress only for a specific date
+            covers = find_changed_covers(store, [target_date], args.changes == 'visual')
+            print(f"Compressing {len(covers)} unique covers changed on {target_date}...")
+        else:
+            # Compress covers from the most recent dates with changes
+            latest_dates = store.dates()[-7:]  # Last 7 days
+            print(f"Compressing covers from last 7 days: {latest_dates}")
+            covers = find_changed_covers(store, latest_dates, args.changes == 'visual')
+            print(f"Total unique covers to compress: {len(covers)} ({args.jobs} encoder processes)")
+
+        # Covers already in the manifest (e.g. encoded by run.py) need no work
+        todo = {md5: isbn for md5, isbn in covers.items() if md5 not in have}
+        success = compress_all(todo, args.jobs, record=store.record_image, target_ssim=args.target_ssim)
+        store.commit()
+        print(f"Compressed: {len(covers) - len(todo) + success}/{len(covers)}")
+
+        data = store.as_dict()
+        if args.gc:
+            collect_garbage(store, data, args.keep_versions)
+
+        # Generate site data and stats from the manifest
+        images = store.images()
+
+    generate_site_data(data, images)
+    print(f"Total images in site/img/: {len(images)} ({sum(r['bytes'] for r in images) / 1024 / 1024:.1f} MB)")
     print("Done.")
 
 
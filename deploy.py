@@ -0,0 +1,114 @@
+"""
+Incremental deploy of site/ to a checked-out Pages repository (cnb.cool / EdgeOne).
+
+Keeps a content-hash manifest of the last deployed state in the target
+(.deploy-manifest.json) and only copies added/modified files and deletes
+removed ones, so a deploy costs about as much as the day's changes instead of
+the whole gallery. Without a manifest in the target, the target's files are
+hashed once to build it.
+
+Usage:
+    python deploy.py plan /tmp/cnb-repo     # show the changed set
+    python deploy.py apply /tmp/cnb-repo    # apply it
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SITE_DIR = os.path.join(SCRIPT_DIR, 'site')
+MANIFEST_NAME = '.deploy-manifest.json'
+IGNORED = {'.git', MANIFEST_NAME}
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_manifest(root):
+    """Map every file under `root` (relative, '/'-separated) to its SHA-1."""
+    manifest = {}
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d not in IGNORED]
+        for f in files:
+            if f in IGNORED:
+                continue
+            path = os.path.join(dirpath, f)
+            manifest[os.path.relpath(path, root).replace(os.sep, '/')] = file_hash(path)
+    return manifest
+
+
+def load_deployed_manifest(target):
+    """Manifest of the last deploy to `target`, rebuilt from its files if missing."""
+    path = os.path.join(target, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    print(f"No {MANIFEST_NAME} in {target}, hashing deployed files...")
+    return build_manifest(target)
+
+
+def diff_manifests(old, new):
+    """Return (added, modified, deleted) path lists."""
+    added = sorted(p for p in new if p not in old)
+    modified = sorted(p for p in new if p in old and old[p] != new[p])
+    deleted = sorted(p for p in old if p not in new)
+    return added, modified, deleted
+
+
+def apply_changes(source, target, added, modified, deleted):
+    for rel in added + modified:
+        dest = os.path.join(target, rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(os.path.join(source, rel), dest)
+    for rel in deleted:
+        path = os.path.join(target, rel)
+        if os.path.exists(path):
+            os.remove(path)
+        # Prune directories left empty
+        parent = os.path.dirname(path)
+        while parent != target and os.path.isdir(parent) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deploy only the changed files of site/ to a target directory")
+    parser.add_argument('command', choices=['plan', 'apply'])
+    parser.add_argument('target', help='Checked-out deploy repository')
+    parser.add_argument('--source', default=SITE_DIR, help='Directory to deploy (default: site/)')
+    parser.add_argument('--changes', help='Also write the changed set to this JSON file')
+    args = parser.parse_args()
+
+    current = build_manifest(args.source)
+    deployed = load_deployed_manifest(args.target)
+    added, modified, deleted = diff_manifests(deployed, current)
+
+    print(f"Deploy plan: {len(added)} added, {len(modified)} modified, {len(deleted)} deleted "
+          f"({len(current)} files in {args.source})")
+    for label, paths in (('+', added), ('M', modified), ('-', deleted)):
+        for p in paths[:50]:
+            print(f"  {label} {p}")
+        if len(paths) > 50:
+            print(f"  {label} ... {len(paths) - 50} more")
+
+    if args.changes:
+        with open(args.changes, 'w') as f:
+            json.dump({'added': added, 'modified': modified, 'deleted': deleted}, f, indent=2)
+
+    if args.command == 'apply':
+        apply_changes(args.source, args.target, added, modified, deleted)
+        with open(os.path.join(args.target, MANIFEST_NAME), 'w') as f:
+            json.dump(current, f, indent=0, sort_keys=True)
+        print(f"Applied to {args.target}")
+
+
+if __name__ == '__main__':
+    main()
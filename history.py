@@ -0,0 +1,315 @@
+"""
+SQLite history store for cover MD5 snapshots (history.db).
+
+history.db is the source of truth for the per-ISBN cover history that used to
+live only in data.json. Lookups by ISBN, date and MD5 are indexed, and a daily
+update only inserts the rows that changed instead of rewriting the whole file.
+data.json is still exported in the same format for backward compatibility.
+
+The probe validators used for conditional requests (ETag, Last-Modified,
+length) are stored alongside in the `probes` table, the manifest of
+encoded gallery images (path, version, size, dimensions, placeholder) in
+`images`, and a perceptual hash (dHash) per cover MD5 in `phashes`, used to
+tell visual cover changes from byte-only re-encodes. The probe scheduler keeps
+each ISBN's on-sale date and last probe date in `schedule`, the catalog crawl
+the ISBNs it has discovered in `catalog`, and run-level state such as the last
+full sweep and the crawl checkpoint in `meta`.
+"""
+
+import json
+import os
+import sqlite3
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'history.db')
+DATA_JSON_PATH = os.path.join(SCRIPT_DIR, 'data.json')
+
+# dHashes differing in at most this many of 64 bits are the same picture
+VISUAL_CHANGE_BITS = 6
+# meta key of the covers of crawl-discovered ISBNs not downloaded yet (run.py --crawl-downloads)
+CRAWL_BACKLOG_KEY = 'crawl_backlog'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    isbn TEXT NOT NULL,
+    date TEXT NOT NULL,
+    md5 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_isbn ON history (isbn, id);
+CREATE INDEX IF NOT EXISTS history_date ON history (date);
+CREATE INDEX IF NOT EXISTS history_md5 ON history (md5);
+
+CREATE TABLE IF NOT EXISTS covers (
+    isbn TEXT PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    date TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,  -- relative to site/img/
+    md5 TEXT,               -- cover version; NULL for legacy per-ISBN files
+    isbn TEXT,
+    bytes INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    lqip TEXT               -- tiny inline placeholder (data: URI)
+);
+CREATE INDEX IF NOT EXISTS images_md5 ON images (md5);
+
+CREATE TABLE IF NOT EXISTS phashes (
+    md5 TEXT PRIMARY KEY,
+    dhash TEXT NOT NULL     -- 64-bit difference hash, hex
+);
+
+CREATE TABLE IF NOT EXISTS schedule (
+    isbn TEXT PRIMARY KEY,
+    onsale TEXT,
+    last_probed TEXT
+);
+
+CREATE TABLE IF NOT EXISTS catalog (
+    isbn TEXT PRIMARY KEY,
+    shard TEXT NOT NULL,    -- crawl shard it was last listed in
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS probes (
+    isbn TEXT PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    length INTEGER
+);
+"""
+
+
+class HistoryStore:
+    """Indexed cover history; use as a context manager so writes are committed."""
+
+    def __init__(self, path=DB_PATH, bootstrap_json=DATA_JSON_PATH):
+        self.path = path
+        # Encode callbacks record images from pool threads; callers serialise access
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+        if bootstrap_json and self.is_empty() and os.path.exists(bootstrap_json):
+            with open(bootstrap_json, 'r') as f:
+                self.import_data(json.load(f))
+            print(f"History store initialised from {bootstrap_json}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.commit()
+        self.conn.close()
+
+    def _migrate(self):
+        """Add columns introduced after a database was created."""
+        columns = {r['name'] for r in self.conn.execute("PRAGMA table_info(images)")}
+        if 'lqip' not in columns:
+            self.conn.execute("ALTER TABLE images ADD COLUMN lqip TEXT")
+
+    def commit(self):
+        self.conn.commit()
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM history LIMIT 1").fetchone() is None
+
+    # -- reads -----------------------------------------------------------
+
+    def latest(self, isbn):
+        """Current MD5 for an ISBN, or None if it has never been seen."""
+        row = self.conn.execute("SELECT md5 FROM covers WHERE isbn = ?", (isbn,)).fetchone()
+        return row['md5'] if row else None
+
+    def latest_all(self):
+        """Map every known ISBN to its current MD5."""
+        return {r['isbn']: r['md5'] for r in self.conn.execute("SELECT isbn, md5 FROM covers")}
+
+    def history(self, isbn):
+        """All {date, md5} entries for an ISBN, oldest first."""
+        rows = self.conn.execute("SELECT date, md5 FROM history WHERE isbn = ? ORDER BY id", (isbn,))
+        return [{'date': r['date'], 'md5': r['md5']} for r in rows]
+
+    def dates(self):
+        """Distinct change dates, ascending."""
+        return [r['date'] for r in self.conn.execute("SELECT DISTINCT date FROM history ORDER BY date")]
+
+    def isbns_changed_on(self, dates):
+        """ISBNs with a history entry on any of `dates`."""
+        dates = list(dates)
+        if not dates:
+            return []
+        marks = ','.join('?' * len(dates))
+        rows = self.conn.execute(f"SELECT DISTINCT isbn FROM history WHERE date IN ({marks})", dates)
+        return [r['isbn'] for r in rows]
+
+    def isbns_with_md5(self, md5):
+        """ISBNs that have ever served the cover `md5`."""
+        return [r['isbn'] for r in self.conn.execute("SELECT DISTINCT isbn FROM history WHERE md5 = ?", (md5,))]
+
+    def change_dates(self):
+        """Map every ISBN to its change dates, oldest first."""
+        dates = {}
+        for r in self.conn.execute("SELECT isbn, date FROM history ORDER BY id"):
+            dates.setdefault(r['isbn'], []).append(r['date'])
+        return dates
+
+    def as_dict(self):
+        """The full history in data.json form: {isbn: [{date, md5}, ...]} in first-seen order."""
+        data = {}
+        for r in self.conn.execute("SELECT isbn, date, md5 FROM history ORDER BY id"):
+            data.setdefault(r['isbn'], []).append({'date': r['date'], 'md5': r['md5']})
+        return data
+
+    def probes(self):
+        """Cached probe validators keyed by ISBN."""
+        rows = self.conn.execute("SELECT isbn, md5, etag, last_modified, length FROM probes")
+        return {r['isbn']: {'md5': r['md5'], 'etag': r['etag'], 'last_modified': r['last_modified'],
+                            'length': r['length']} for r in rows}
+
+    def images(self):
+        """The image manifest: one dict per encoded file in site/img/."""
+        rows = self.conn.execute("SELECT path, md5, isbn, bytes, width, height, lqip FROM images ORDER BY path")
+        return [dict(r) for r in rows]
+
+    def schedule(self):
+        """On-sale and last-probed dates keyed by ISBN."""
+        rows = self.conn.execute("SELECT isbn, onsale, last_probed FROM schedule")
+        return {r['isbn']: {'onsale': r['onsale'], 'last_probed': r['last_probed']} for r in rows}
+
+    def crawl_backlog(self):
+        """Covers of crawl-discovered ISBNs still waiting to be downloaded: {isbn: md5}."""
+        return json.loads(self.get_meta(CRAWL_BACKLOG_KEY) or '{}')
+
+    def catalog(self):
+        """ISBNs discovered by the catalog crawl, in discovery order."""
+        return [r['isbn'] for r in self.conn.execute("SELECT isbn FROM catalog ORDER BY rowid")]
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def phashes(self):
+        """Perceptual hashes keyed by cover MD5."""
+        return {r['md5']: r['dhash'] for r in self.conn.execute("SELECT md5, dhash FROM phashes")}
+
+    def change_kind(self, isbn):
+        """Classify the ISBN's latest history entry against the versions before it.
+
+        Returns 'new' (first version), 'revert' (an MD5 it served before),
+        'bytes' (dHash within VISUAL_CHANGE_BITS of the previous version, i.e.
+        a re-encode of the same picture) or 'visual'. Changes are treated as
+        visual when either perceptual hash is unknown.
+        """
+        md5s = [e['md5'] for e in self.history(isbn)]
+        if len(md5s) < 2:
+            return 'new'
+        if md5s[-1] in md5s[:-1]:
+            return 'revert'
+        rows = self.conn.execute("SELECT md5, dhash FROM phashes WHERE md5 IN (?, ?)", md5s[-2:])
+        hashes = {r['md5']: r['dhash'] for r in rows}
+        if len(hashes) < 2:
+            return 'visual'
+        distance = bin(int(hashes[md5s[-1]], 16) ^ int(hashes[md5s[-2]], 16)).count('1')
+        return 'bytes' if distance <= VISUAL_CHANGE_BITS else 'visual'
+
+    # -- writes ----------------------------------------------------------
+
+    def record(self, isbn, date, md5):
+        """Append a history entry if `md5` differs from the ISBN's current cover.
+
+        Returns 'new', 'changed' or None (unchanged).
+        """
+        current = self.latest(isbn)
+        if current == md5:
+            return None
+        self.conn.execute("INSERT INTO history (isbn, date, md5) VALUES (?, ?, ?)", (isbn, date, md5))
+        self.conn.execute("INSERT OR REPLACE INTO covers (isbn, md5, date) VALUES (?, ?, ?)", (isbn, md5, date))
+        return 'new' if current is None else 'changed'
+
+    def set_probe(self, isbn, entry):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO probes (isbn, md5, etag, last_modified, length) VALUES (?, ?, ?, ?, ?)",
+            (isbn, entry['md5'], entry.get('etag'), entry.get('last_modified'), entry.get('length')))
+
+    def set_onsale(self, dates):
+        """Store on-sale dates from the listing ({isbn: YYYY-MM-DD})."""
+        self.conn.executemany(
+            "INSERT INTO schedule (isbn, onsale) VALUES (?, ?) ON CONFLICT (isbn) DO UPDATE SET onsale = excluded.onsale",
+            dates.items())
+
+    def mark_probed(self, isbns, date):
+        self.conn.executemany(
+            "INSERT INTO schedule (isbn, last_probed) VALUES (?, ?) "
+            "ON CONFLICT (isbn) DO UPDATE SET last_probed = excluded.last_probed",
+            [(isbn, date) for isbn in isbns])
+
+    def add_catalog(self, isbns, shard, date):
+        self.conn.executemany(
+            "INSERT INTO catalog (isbn, shard, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (isbn) DO UPDATE SET shard = excluded.shard, last_seen = excluded.last_seen",
+            [(isbn, shard, date, date) for isbn in isbns])
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def set_phash(self, md5, dhash):
+        self.conn.execute("INSERT OR REPLACE INTO phashes (md5, dhash) VALUES (?, ?)", (md5, dhash))
+
+    def record_image(self, info):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO images (path, md5, isbn, bytes, width, height, lqip) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (info['path'], info.get('md5'), info.get('isbn'), info['bytes'], info.get('width'), info.get('height'),
+             info.get('lqip')))
+
+    def remove_image(self, path):
+        self.conn.execute("DELETE FROM images WHERE path = ?", (path,))
+
+    def import_data(self, data):
+        """Load a data.json-style dict into an empty store."""
+        rows = [(isbn, e['date'], e['md5']) for isbn, entries in data.items() for e in entries]
+        self.conn.executemany("INSERT INTO history (isbn, date, md5) VALUES (?, ?, ?)", rows)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO covers (isbn, md5, date) VALUES (?, ?, ?)",
+            [(isbn, entries[-1]['md5'], entries[-1]['date']) for isbn, entries in data.items() if entries])
+        self.conn.commit()
+
+    def export_json(self, path=DATA_JSON_PATH):
+        """Write data.json in its original format."""
+        data = self.as_dict()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+        return data
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query or export the cover history store")
+    parser.add_argument('--isbn', help='Print the history of one ISBN')
+    parser.add_argument('--date', help='List ISBNs that changed on a date')
+    parser.add_argument('--md5', help='List ISBNs that ever served a cover MD5')
+    parser.add_argument('--export', action='store_true', help='Export data.json')
+    args = parser.parse_args()
+
+    with HistoryStore() as store:
+        if args.isbn:
+            print(json.dumps(store.history(args.isbn), indent=2))
+        if args.date:
+            print('\n'.join(store.isbns_changed_on([args.date])))
+        if args.md5:
+            print('\n'.join(store.isbns_with_md5(args.md5)))
+        if args.export:
+            store.export_json()
+            print(f"Exported {DATA_JSON_PATH}")
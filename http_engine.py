@@ -0,0 +1,237 @@
+"""
+Async HTTP engine for images2.penguinrandomhouse.com (no anti-bot on this domain).
+
+One aiohttp session with a pooled keep-alive connector is shared by every
+stage. Concurrency is not a fixed worker count: an AIMD limiter grows the
+number of in-flight requests while responses are fast and healthy and halves
+it on 429/5xx, errors or slow responses. Every request is timed so each stage
+can print its throughput.
+
+DomainRateLimiter spaces requests per host for domains that need a fixed
+politeness rate instead (the prhcomics.com listing during a catalog crawl).
+"""
+
+import asyncio
+import os
+import time
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+IMAGES2_BASE = 'https://images2.penguinrandomhouse.com'
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36"
+
+Response = namedtuple('Response', ['status', 'headers', 'body', 'elapsed'])
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by response latency and status codes."""
+
+    def __init__(self, initial=16, minimum=2, maximum=128, latency_target=2.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.peak = initial
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, elapsed, status):
+        async with self._cond:
+            self.in_flight -= 1
+            overloaded = status is None or status == 429 or status >= 500
+            if overloaded or elapsed > self.latency_target:
+                # Decrease at most once per latency window so one burst of
+                # failures doesn't collapse the limit to the minimum.
+                now = time.monotonic()
+                if now - self._last_decrease > self.latency_target:
+                    self.limit = max(self.minimum, self.limit // 2 if overloaded else self.limit - 1)
+                    self._last_decrease = now
+                self._successes = 0
+            else:
+                # Additive increase: +1 after a full window of good responses
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.peak = max(self.peak, self.limit)
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class DomainRateLimiter:
+    """Per-host request spacing: at most `rates[host]` (or `default_rate`) requests per second."""
+
+    def __init__(self, default_rate=2.0, rates=None):
+        self.default_rate = default_rate
+        self.rates = rates or {}
+        self._next = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, url):
+        """Sleep until a request to `url`'s host is allowed."""
+        host = urlsplit(url).hostname or url
+        interval = 1.0 / self.rates.get(host, self.default_rate)
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + interval
+        await asyncio.sleep(start - now)
+
+
+class RequestStats:
+    """Per-request timing and byte counts for one stage."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = []
+        self.statuses = Counter()
+        self.bytes = 0
+
+    def record(self, elapsed, status, size):
+        self.latencies.append(elapsed)
+        self.statuses[status if status is not None else 'error'] += 1
+        self.bytes += size
+
+    def summary(self):
+        wall = time.monotonic() - self.started
+        n = len(self.latencies)
+        if not n:
+            return "0 requests"
+        lat = sorted(self.latencies)
+        p50 = lat[n // 2]
+        p95 = lat[min(n - 1, int(n * 0.95))]
+        statuses = ', '.join(f"{k}: {v}" for k, v in sorted(self.statuses.items(), key=str))
+        return (f"{n} requests in {wall:.1f}s ({n / wall:.1f} req/s, {self.bytes / 1024 / wall:.0f} KB/s), "
+                f"latency p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms, status {{{statuses}}}")
+
+
+class Images2Client:
+    """Shared async client for the images2 cover domain."""
+
+    def __init__(self, max_connections=100, initial_concurrency=16, max_concurrency=100, timeout=30, retries=3):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = AdaptiveLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.stats = RequestStats()
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(
+            base_url=IMAGES2_BASE,
+            connector=connector,
+            headers={'User-Agent': USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def request(self, method, path, headers=None, timeout=None):
+        """Send one request, retrying 429/5xx/network errors with backoff.
+
+        Returns a Response with the full body, or None if every attempt failed.
+        """
+        for attempt in range(self.retries + 1):
+            status = None
+            size = 0
+            await self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                kwargs = {'headers': headers}
+                if timeout:
+                    kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+                async with self.session.request(method, path, **kwargs) as resp:
+                    body = await resp.read()
+                    status = resp.status
+                    size = len(body)
+                    result = Response(status, resp.headers, body, time.monotonic() - start)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                result = None
+            finally:
+                elapsed = time.monotonic() - start
+                self.stats.record(elapsed, status, size)
+                await self.limiter.release(elapsed, status)
+
+            if result is not None and result.status != 429 and result.status < 500:
+                return result
+            if attempt < self.retries:
+                delay = 2 ** attempt
+                if result is not None and result.headers.get('Retry-After', '').isdigit():
+                    delay = max(delay, int(result.headers['Retry-After']))
+                await asyncio.sleep(delay)
+        return result
+
+    async def download(self, path, dest, timeout=300):
+        """Stream `path` to `dest` via `dest.part`, resuming with Range requests on retry.
+
+        The file is only renamed into place once its size matches Content-Length.
+        The limiter is fed time-to-first-byte rather than the total duration,
+        which for a large file always exceeds the latency target and would
+        keep shrinking the concurrency. Returns a dict describing the outcome
+        for the run manifest.
+        """
+        part = dest + '.part'
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            await self.limiter.acquire()
+            start = time.monotonic()
+            status, size, error, retryable, ttfb = None, 0, None, True, None
+            try:
+                status, size, error, retryable, ttfb = await self._stream_to(path, part, offset, timeout, start)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                error = f'{type(e).__name__}: {e}'
+            finally:
+                elapsed = time.monotonic() - start
+                self.stats.record(elapsed, status, size)
+                await self.limiter.release(ttfb if ttfb is not None else elapsed, status)
+
+            if error is None:
+                os.replace(part, dest)
+                total = os.path.getsize(dest)
+                return {'status': 'ok', 'bytes': total, 'resumed_from': total - size, 'attempts': attempt + 1}
+            if not retryable:
+                break
+            if attempt < self.retries:
+                await asyncio.sleep(2 ** attempt)
+        return {'status': 'failed', 'error': error, 'attempts': attempt + 1}
+
+    async def _stream_to(self, path, part, offset, timeout, start):
+        """One download attempt; returns (status, bytes_read, error, retryable, time_to_first_byte)."""
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        async with self.session.get(path, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            ttfb = time.monotonic() - start
+            if resp.status == 206:
+                expected = int(resp.headers.get('Content-Range', '*/*').rsplit('/', 1)[1].replace('*', '0')) or None
+                mode = 'ab'
+            elif resp.status == 200:
+                expected = resp.content_length
+                offset = 0
+                mode = 'wb'
+            elif resp.status == 416 and offset:
+                # Stale .part at least as large as the file; start over
+                os.remove(part)
+                return resp.status, 0, 'HTTP 416', True, ttfb
+            else:
+                return resp.status, 0, f'HTTP {resp.status}', resp.status == 429 or resp.status >= 500, ttfb
+
+            size = 0
+            with open(part, mode) as f:
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+
+        if expected is not None and offset + size != expected:
+            return resp.status, size, f'size mismatch: got {offset + size} of {expected} bytes', True, ttfb
+        return resp.status, size, None, True, ttfb
@@ -0,0 +1,140 @@
+"""
+Anti-bot session handling for prhcomics.com (Fastly client JS challenge).
+
+A solved session (clearance cookies, user agent, nonce) is cached in
+.prh_session.json with an expiry. The next run tries it with a plain aiohttp
+client first and only launches Chromium via Playwright when it is rejected.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SESSION_FILE = os.path.join(SCRIPT_DIR, '.prh_session.json')
+
+SITE_URL = "https://prhcomics.com/"
+AJAX_URL = "https://prhcomics.com/wp/wp-admin/admin-ajax.php"
+NONCE_URL = f"{AJAX_URL}?action=get_nonce"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36"
+
+SESSION_TTL = 12 * 3600       # WordPress nonces are valid for 12-24h
+CHALLENGE_TIMEOUT = 30        # Max seconds to wait for the JS challenge to clear
+CHALLENGE_POLL_INTERVAL = 1
+
+
+def load_session():
+    """Return the cached session dict, or None if missing or expired."""
+    if not os.path.exists(SESSION_FILE):
+        return None
+    try:
+        with open(SESSION_FILE, 'r') as f:
+            session = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if session.get('expires', 0) <= time.time():
+        return None
+    return session
+
+
+def save_session(cookies, user_agent, nonce):
+    """Persist clearance cookies, user agent and nonce; expiry is the earliest cookie expiry or SESSION_TTL."""
+    expires = time.time() + SESSION_TTL
+    for c in cookies:
+        if c.get('expires', -1) > 0:
+            expires = min(expires, c['expires'])
+    session = {'cookies': cookies, 'user_agent': user_agent, 'nonce': nonce, 'expires': expires}
+    with open(SESSION_FILE, 'w') as f:
+        json.dump(session, f, indent=2)
+    return session
+
+
+def parse_nonce(text):
+    """Return the nonce from a get_nonce response, or None for a challenge page."""
+    if not text.startswith('{'):
+        return None
+    try:
+        return json.loads(text).get('nonce')
+    except json.JSONDecodeError:
+        return None
+
+
+class TextResponse:
+    """Already-read response with the same `await resp.text()` interface as Playwright's APIResponse."""
+
+    def __init__(self, status, text):
+        self.status = status
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+
+class PlainSession:
+    """aiohttp client replaying a cached session; quacks like Playwright's `context.request`."""
+
+    def __init__(self, session):
+        self.session = session
+        self.http = None
+
+    async def __aenter__(self):
+        cookies = {c['name']: c['value'] for c in self.session.get('cookies', [])}
+        self.http = aiohttp.ClientSession(
+            cookies=cookies,
+            headers={'User-Agent': self.session.get('user_agent', USER_AGENT)},
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.http.close()
+
+    async def get(self, url, headers=None):
+        async with self.http.get(url, headers=headers) as resp:
+            return TextResponse(resp.status, await resp.text())
+
+    async def post(self, url, data=None, headers=None):
+        async with self.http.post(url, data=data, headers=headers) as resp:
+            return TextResponse(resp.status, await resp.text())
+
+
+async def fetch_nonce(request, timeout=0):
+    """GET the nonce, polling until the challenge clears or `timeout` seconds pass."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            resp = await request.get(NONCE_URL)
+            nonce = parse_nonce(await resp.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            nonce = None
+        if nonce or time.monotonic() >= deadline:
+            return nonce
+        await asyncio.sleep(CHALLENGE_POLL_INTERVAL)
+
+
+async def solve_with_browser(playwright):
+    """Launch Chromium, wait for the JS challenge to clear and cache the resulting session.
+
+    Returns (browser, context, nonce); the caller closes the browser.
+    """
+    browser = await playwright.chromium.launch(headless=True)
+    context = await browser.new_context(user_agent=USER_AGENT)
+    page = await context.new_page()
+
+    print("[1/4] Navigating to prhcomics.com...")
+    await page.goto(SITE_URL, wait_until="domcontentloaded", timeout=30000)
+
+    print("[2/4] Waiting for challenge to clear and fetching nonce...")
+    start = time.monotonic()
+    nonce = await fetch_nonce(context.request, timeout=CHALLENGE_TIMEOUT)
+    if nonce is None:
+        await browser.close()
+        raise RuntimeError(f"Challenge did not clear within {CHALLENGE_TIMEOUT}s")
+    print(f"[2/4] Challenge cleared after {time.monotonic() - start:.1f}s")
+
+    cookies = [c for c in await context.cookies() if 'prhcomics.com' in c.get('domain', '')]
+    save_session(cookies, USER_AGENT, nonce)
+    return browser, context, nonce
@@ -1,263 +1,877 @@
 import asyncio
 import json
 import hashlib
-import concurrent.futures
 from datetime import datetime
+from urllib.parse import quote
 from playwright.async_api import async_playwright
 import os
 import re
 import shutil
 import argparse
-import requests
+import itertools
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import compress
+import scheduler
+from history import CRAWL_BACKLOG_KEY, HistoryStore
+from http_engine import DomainRateLimiter, Images2Client
+from prh_session import AJAX_URL, PlainSession, fetch_nonce, load_session, solve_with_browser
 
 today = datetime.now().strftime('%Y-%m-%d')
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 data_file_path = os.path.join(SCRIPT_DIR, 'data.json')
 image_directory = os.path.join(SCRIPT_DIR, 'covers')
+manifest_directory = os.path.join(SCRIPT_DIR, 'manifests')
+checkpoint_directory = os.path.join(SCRIPT_DIR, 'checkpoints')
+
+STAGES = ['listing', 'probe', 'history', 'download', 'upload']
+ENCODE_QUEUE_SIZE = 32
+PHASH_THUMB_WIDTH = 64   # The height=1 probe is too small to hash
+PRODUCT_LIST_ROWS = 36
+LISTING_FANOUT = 6
+COMING_SOON = {"label": "Coming Soon", "filterId": "sale-status", "key": "onSaleFrom", "value": "tomorrow"}
+ALREADY_ON_SALE = {"label": "Already On Sale", "filterId": "sale-status", "key": "onSaleTo", "value": "today"}
+LISTING_FILTERS = {
+    "l1_category": "all-categories-manga",
+    "filters": {
+        "category": [],
+        "sale-status": [COMING_SOON],
+        "format": [], "age": [], "grade": [], "guides": [], "publisher": [], "comics_publisher": []
+    }
+}
+
+# Catalog crawl shards: every combination of one value per dimension, using the
+# same `filters` structure as the listing. None leaves a dimension unfiltered;
+# add "format"/"category" filter objects here to split large shards further.
+CRAWL_DIMENSIONS = {
+    "l1_category": ["all-categories-manga"],
+    "sale-status": [COMING_SOON, ALREADY_ON_SALE],
+    "format": [None],
+}
+CRAWL_CHECKPOINT_KEY = 'crawl_checkpoint'
+CRAWL_DOWNLOADS = 100   # Covers of crawl-discovered ISBNs downloaded per run
+LISTING_RATE = 2.0   # prhcomics.com listing requests per second during a crawl
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--token', type=str, help='HuggingFace token')
+parser.add_argument('--stage', nargs='+', choices=STAGES, default=STAGES,
+                    help='Stages to run (default: all); finished stages of this run are skipped')
+parser.add_argument('--run', help='Run date (YYYY-MM-DD) whose checkpoint to resume (default: today)')
+parser.add_argument('--restart', action='store_true', help='Discard this run\'s checkpoint and start over')
+parser.add_argument('--probe', choices=['conditional', 'head', 'full'], default='conditional',
+                    help='How to detect cover changes: conditional GET (default), HEAD, or always download')
+parser.add_argument('--compress', action=argparse.BooleanOptionalAction, default=True,
+                    help='Encode gallery AVIFs from the downloaded TIFs as they arrive')
+parser.add_argument('--export-json', action=argparse.BooleanOptionalAction, default=True,
+                    help='Export data.json from history.db after updating')
+parser.add_argument('--max-concurrency', type=int, default=100,
+                    help='Upper bound for the adaptive images2 request concurrency')
+parser.add_argument('--schedule', action=argparse.BooleanOptionalAction, default=True,
+                    help='Only probe ISBNs due by their change-likelihood interval (see scheduler.py)')
+parser.add_argument('--sweep-days', type=int, default=scheduler.FULL_SWEEP_DAYS,
+                    help='Probe every ISBN when the last full sweep is this many days old')
+parser.add_argument('--crawl', action='store_true',
+                    help='Also crawl the wider catalog shard by shard (checkpointed across runs) and probe it')
+parser.add_argument('--crawl-minutes', type=float, default=20,
+                    help='Time budget for the catalog crawl in this run')
+parser.add_argument('--crawl-downloads', type=int, default=CRAWL_DOWNLOADS,
+                    help='Download at most this many covers of ISBNs first seen by the crawl per run; '
+                         'the rest wait in a backlog')
+parser.add_argument('--listing-rate', type=float, default=LISTING_RATE,
+                    help='Max prhcomics.com listing requests per second while crawling')
+parser.add_argument('--changes', choices=['all', 'visual'], default='all',
+                    help='Download every changed cover, or only visual changes and reverts to versions we lack')
+parser.add_argument('--target-ssim', type=float, default=None,
+                    help='Encode gallery images at the lowest quality reaching this SSIM instead of fixed settings')
+
+
+def probe_validators(resp, md5, length):
+    """Build the probe cache entry for a cover response."""
+    return {
+        'md5': md5,
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+        'length': length,
+    }
+
+
+def validators_match(cached, resp):
+    """Check whether HEAD response headers still describe the cached cover."""
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    length = resp.headers.get('Content-Length')
+    if not (etag or last_modified):
+        return False
+    if etag and etag != cached.get('etag'):
+        return False
+    if last_modified and last_modified != cached.get('last_modified'):
+        return False
+    if length is not None and int(length) != cached.get('length'):
+        return False
+    return True
+
+
+async def download_and_encode(client, store, covers, encode=True, target_ssim=None):
+    """Download changed TIFs once per unique cover and encode each gallery image in a process pool.
+
+    `covers` maps cover MD5 -> ISBNs now serving it. The TIF is fetched for the
+    first ISBN and hard-linked for the rest, so the archive keeps one file per
+    ISBN without downloading shared covers twice. Downloads feed a bounded
+    queue so network and CPU work overlap without compress.py having to fetch
+    the same covers again.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=ENCODE_QUEUE_SIZE)
+    results = {}
+    workers = os.cpu_count() or 2
+
+    async def download_cover(md5, isbns):
+        dest = os.path.join(image_directory, f"{isbns[0]}.tif.{today}")
+        if os.path.exists(dest):
+            # Finished by an interrupted earlier attempt of this run (only complete files are renamed into place)
+            result = {'status': 'ok', 'bytes': os.path.getsize(dest), 'resumed_from': os.path.getsize(dest),
+                      'attempts': 0}
+        else:
+            result = await client.download(f"/cover/tif/{isbns[0]}", dest)
+        result['md5'] = md5
+        results[isbns[0]] = result
+        for isbn in isbns[1:]:
+            if result['status'] != 'ok':
+                results[isbn] = {'status': 'failed', 'md5': md5, 'attempts': 0,
+                                 'error': f"shared download from {isbns[0]} failed"}
+                continue
+            link = os.path.join(image_directory, f"{isbn}.tif.{today}")
+            if not os.path.exists(link):
+                os.link(dest, link)
+            results[isbn] = {'status': 'ok', 'md5': md5, 'linked_from': isbns[0]}
+        if result['status'] != 'ok':
+            return
+        if encode:
+            await queue.put((md5, isbns[0], dest))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        async def encoder():
+            while (item := await queue.get()) is not None:
+                md5, isbn, path = item
+                error = None
+                try:
+                    records = await loop.run_in_executor(pool, compress.encode_cover, md5, path, isbn, target_ssim)
+                    for info in records or ():
+                        store.record_image(info)
+                except Exception as e:
+                    # A dead worker (BrokenProcessPool) or a store error must not stop the
+                    # encoder: downloads block on the bounded queue until it is drained.
+                    print(f"  [WARN] Encoding {md5} ({isbn}) failed: {type(e).__name__}: {e}")
+                    records, error = None, f'{type(e).__name__}: {e}'
+                for r in results.values():
+                    if r.get('md5') == md5:
+                        r['encoded'] = records is not None
+                        if error:
+                            r['encode_error'] = error
+
+        encoders = [asyncio.create_task(encoder()) for _ in range(workers)]
+        await asyncio.gather(*(download_cover(md5, isbns) for md5, isbns in covers.items()))
+        for _ in encoders:
+            await queue.put(None)
+        await asyncio.gather(*encoders)
+
+    if encode:
+        encoded = len({r['md5'] for r in results.values() if r.get('encoded')})
+        print(f"Encoded {encoded}/{len(covers)} unique gallery images from downloaded TIFs ({workers} processes)")
+    return results
+
+
+def group_covers(latest, isbns):
+    """Group ISBNs by their current cover MD5, leaving out known placeholder covers."""
+    covers = {}
+    for isbn in sorted(isbns):
+        md5 = latest[isbn]
+        if md5 not in compress.PLACEHOLDER_MD5S:
+            covers.setdefault(md5, []).append(isbn)
+    return covers
+
+
+def write_download_manifest(results):
+    """Record per-ISBN download outcomes for this run in manifests/{today}-download.json."""
+    os.makedirs(manifest_directory, exist_ok=True)
+    path = os.path.join(manifest_directory, f"{today}-download.json")
+    manifest = {
+        'date': today,
+        'ok': sum(1 for r in results.values() if r['status'] == 'ok'),
+        'failed': sum(1 for r in results.values() if r['status'] != 'ok'),
+        'covers': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Download manifest saved to {path}")
+
+
+def product_list_form(nonce, filters_json, start, rows=PRODUCT_LIST_ROWS):
+    """Build the urlencoded get_product_list form body for one page."""
+    return (
+        f"product_load_nonce={nonce}"
+        f"&action=get_product_list"
+        f"&postType=page"
+        f"&postId=11538"
+        f"&isbns=%5B%5D"
+        f"&params=%7B%22source-page%22%3A%22category-landing-page%22%7D"
+        f"&filters={quote(filters_json)}"
+        f"&layout=grid-lg"
+        f"&start={start}"
+        f"&rows={rows}"
+        f"&sort=frontlistiest_onsale%3Adesc"
+    )
+
+
+async def fetch_product_page(request, nonce, filters_json, start, retries=3, limiter=None):
+    """POST one get_product_list page, retrying challenge pages and success=false.
+
+    Returns the response's `data` dict, or None if every attempt failed. With a
+    DomainRateLimiter, every attempt waits for its turn first.
+    """
+    for attempt in range(retries + 1):
+        if limiter:
+            await limiter.wait(AJAX_URL)
+        resp = await request.post(
+            AJAX_URL,
+            data=product_list_form(nonce, filters_json, start),
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+                "X-Requested-With": "XMLHttpRequest",
+                "Referer": "https://prhcomics.com/themes/?catUri=all-categories-manga",
+            }
+        )
+        text = await resp.text()
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            print(f"  [WARN] JSON decode failed at start={start} (attempt {attempt + 1}), response: {text[:200]}")
+        else:
+            if data.get('success'):
+                return data.get('data', {})
+            print(f"  [WARN] API returned success=false at start={start} (attempt {attempt + 1})")
+        if attempt < retries:
+            await asyncio.sleep(2 ** attempt)
+    return None
+
+
+def page_isbns(page):
+    """Extract ISBNs from a get_product_list page, falling back to the rendered HTML."""
+    isbns = page.get('isbns', [])
+    if not isbns:
+        isbns = re.findall(r'data-isbn="(\d+)"', page.get('content', ''))
+    return isbns
+
+
+ONSALE_PATTERN = re.compile(
+    r'prod-grid-meta-isbn">(\d+)</div>(?:(?!prod-grid-meta-isbn).)*?'
+    r'prod-grid-meta-onsale">\s*On sale\s*([A-Z][a-z]{2} \d{1,2}, \d{4})', re.S)
+
+
+def page_onsale_dates(page):
+    """Map ISBN -> on-sale date (YYYY-MM-DD) from a page's rendered HTML."""
+    return {isbn: datetime.strptime(when, '%b %d, %Y').strftime('%Y-%m-%d')
+            for isbn, when in ONSALE_PATTERN.findall(page.get('content', ''))}
+
+
+async def fetch_all_isbns(request, nonce, filters, rows=PRODUCT_LIST_ROWS, fanout=LISTING_FANOUT, onsale=None):
+    """Fetch every listing page and return unique ISBNs in listing order.
+
+    The first page gives `total`; the remaining offsets are fetched concurrently
+    (at most `fanout` in flight), each retried on its own. If `onsale` is a
+    dict, it is filled with the on-sale dates shown in the listing.
+    """
+    filters_json = json.dumps(filters)
+    first = await fetch_product_page(request, nonce, filters_json, 0)
+    if first is None or not page_isbns(first):
+        print("  No ISBNs at start=0, stopping.")
+        return []
+
+    total = first.get('total', 0)
+    print(f"  Total available: {total}")
+    pages = {0: first}
+
+    semaphore = asyncio.Semaphore(fanout)
+
+    async def fetch_page(start):
+        async with semaphore:
+            page = await fetch_product_page(request, nonce, filters_json, start)
+            if page is not None:
+                print(f"  Fetched {len(page_isbns(page))} ISBNs at start={start}")
+            return start, page
+
+    offsets = list(range(rows, total, rows)) if first.get('more') else []
+    failed = set()
+    while offsets:
+        for start, page in await asyncio.gather(*(fetch_page(s) for s in offsets)):
+            if page is None:
+                print(f"  [WARN] Giving up on page start={start}")
+                failed.add(start)
+            else:
+                pages[start] = page
+        # `total` can lag behind the live list; keep going while the last page says there is more,
+        # unless that next page was already given up on
+        last = max(pages)
+        offsets = [last + rows] if pages[last].get('more') and page_isbns(pages[last]) else []
+        offsets = [start for start in offsets if start not in failed]
+
+    # Concatenate in offset order and deduplicate, keeping first occurrence
+    seen = set()
+    all_isbns = []
+    for start in sorted(pages):
+        if onsale is not None:
+            onsale.update(page_onsale_dates(pages[start]))
+        for isbn in page_isbns(pages[start]):
+            if isbn not in seen:
+                seen.add(isbn)
+                all_isbns.append(isbn)
+    print(f"  Fetched {len(pages)} pages, {len(all_isbns)}/{total} ISBNs")
+    return all_isbns
+
+
+def crawl_shards(dimensions=CRAWL_DIMENSIONS):
+    """Return [(key, filters)] for every combination of the crawl dimensions."""
+    names = list(dimensions)
+    shards = []
+    for values in itertools.product(*(dimensions[n] for n in names)):
+        filters = {"l1_category": None, "filters": {k: [] for k in LISTING_FILTERS["filters"]}}
+        labels = []
+        for name, value in zip(names, values):
+            if name == "l1_category":
+                filters["l1_category"] = value
+                labels.append(value)
+            else:
+                filters["filters"][name] = [value] if value else []
+                labels.append(value["label"] if value else "*")
+        shards.append(('|'.join(labels), filters))
+    return shards
+
+
+async def crawl_catalog(request, nonce, store, deadline, rows=PRODUCT_LIST_ROWS, fanout=LISTING_FANOUT,
+                        limiter=None):
+    """Walk the catalog shards page by page until done or `deadline` (monotonic), checkpointing as it goes.
+
+    Progress ({shard: {next, total, done}}) is kept in history.db meta, so a
+    crawl spans as many runs as it needs; when every shard is done the next
+    run starts a new pass. Discovered ISBNs go to the `catalog` table and
+    their on-sale dates to `schedule`. Returns the number of ISBNs seen.
+    """
+    checkpoint = json.loads(store.get_meta(CRAWL_CHECKPOINT_KEY) or '{}')
+    shards = crawl_shards()
+    if not checkpoint or all(checkpoint['shards'].get(k, {}).get('done') for k, _ in shards):
+        checkpoint = {'started': today, 'shards': {}}
+        print(f"  Crawl: starting a new pass over {len(shards)} shards")
+    seen = 0
+
+    for key, filters in shards:
+        state = checkpoint['shards'].setdefault(key, {'next': 0, 'total': None, 'done': False})
+        filters_json = json.dumps(filters)
+        semaphore = asyncio.Semaphore(fanout)
+
+        async def fetch_page(start):
+            async with semaphore:
+                return await fetch_product_page(request, nonce, filters_json, start, limiter=limiter)
+
+        failed = False
+        while not state['done'] and not failed and time.monotonic() < deadline:
+            # Pages are applied in offset order so the checkpoint never skips one
+            offsets = [state['next'] + i * rows for i in range(fanout)]
+            pages = await asyncio.gather(*(fetch_page(start) for start in offsets))
+            for start, page in zip(offsets, pages):
+                if page is None:
+                    print(f"  [WARN] Crawl {key}: giving up on start={start} until the next run")
+                    failed = True
+                    break
+                isbns = page_isbns(page)
+                state['total'] = page.get('total', state['total'])
+                store.add_catalog(isbns, key, today)
+                store.set_onsale(page_onsale_dates(page))
+                seen += len(isbns)
+                state['next'] = start + rows
+                if not isbns or not page.get('more'):
+                    state['done'] = True
+                    break
+            store.set_meta(CRAWL_CHECKPOINT_KEY, json.dumps(checkpoint))
+            store.commit()
+        print(f"  Crawl {key}: {'done' if state['done'] else 'paused'} at {state['next']}/{state['total']}")
+
+    done = sum(1 for k, _ in shards if checkpoint['shards'].get(k, {}).get('done'))
+    print(f"  Crawl: {seen} ISBNs listed this run, {done}/{len(shards)} shards done in pass from {checkpoint['started']}")
+    return seen
+
+
+async def probe_md5(client, isbn, cached, mode):
+    """Return (md5, new_cache_entry) for one cover; entry is None when the cached MD5 still holds."""
+    path = f"/cover/{isbn}?height=1"
+    if cached and mode == 'head':
+        r = await client.request('HEAD', path, timeout=15)
+        if r is not None and r.status == 200 and validators_match(cached, r):
+            return cached['md5'], None
+    headers = {}
+    if cached and mode == 'conditional':
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    r = await client.request('GET', path, headers=headers, timeout=15)
+    if r is None:
+        return None, None
+    if r.status == 304 and cached:
+        return cached['md5'], None
+    if r.status == 200:
+        md5 = hashlib.md5(r.body).hexdigest()
+        return md5, probe_validators(r, md5, len(r.body))
+    return None, None
+
+
+async def fetch_dhash(client, isbn):
+    """Perceptual hash of the cover currently served for `isbn`, from a small thumbnail; None on failure."""
+    r = await client.request('GET', f"/cover/{isbn}?width={PHASH_THUMB_WIDTH}", timeout=15)
+    if r is None or r.status != 200:
+        return None
+    try:
+        return compress.dhash(r.body)
+    except Exception:
+        return None
+
+
+def select_downloads(store, changed, mode):
+    """Pick which changed covers to download; returns ({isbn: md5}, {kind: count}).
+
+    Every change is classified with HistoryStore.change_kind. In 'visual'
+    mode byte-only changes are skipped, as are reverts to a version that
+    already has a gallery image. Placeholder covers are never selected:
+    group_covers would drop them, so they would never finish downloading.
+    """
+    have = {r['md5'] for r in store.images() if r['md5']}
+    selected = {}
+    kinds = {}
+    for isbn, md5 in changed.items():
+        if md5 in compress.PLACEHOLDER_MD5S:
+            continue
+        kind = store.change_kind(isbn)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        if mode == 'visual' and (kind == 'bytes' or (kind == 'revert' and md5 in have)):
+            continue
+        selected[isbn] = md5
+    return selected, kinds
+
+
+async def fetch_listing(onsale=None, crawl=None):
+    """Return the listing ISBNs, replaying the cached session when possible and using Playwright otherwise.
+
+    On-sale dates from the listing are collected into `onsale` if given.
+    `crawl(request, nonce)` is awaited with the same session after the listing.
+    """
+    session = load_session()
+    if session:
+        print("[1/4] Trying cached anti-bot session...")
+        async with PlainSession(session) as http:
+            nonce = await fetch_nonce(http)
+            if nonce:
+                print(f"[2/4] Cached session accepted, nonce: {nonce}")
+                print("[3/4] Fetching all ISBNs via plain HTTP...")
+                all_isbns = await fetch_all_isbns(http, nonce, LISTING_FILTERS, onsale=onsale)
+                if all_isbns:
+                    if crawl:
+                        await crawl(http, nonce)
+                    return all_isbns
+        print("[1/4] Cached session rejected, falling back to browser")
 
-async def main():
     print("[1/4] Launching browser to bypass bot protection...")
     async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        context = await browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36"
-        )
-        page = await context.new_page()
-
-        print("[1/4] Navigating to prhcomics.com...")
-        await page.goto("https://prhcomics.com/", wait_until="domcontentloaded", timeout=30000)
-        await page.wait_for_timeout(8000)
-
-        # Fetch nonce via browser context
-        print("[2/4] Fetching nonce via browser...")
-        nonce_resp = await context.request.get(
-            "https://prhcomics.com/wp/wp-admin/admin-ajax.php?action=get_nonce"
-        )
-        nonce_text = await nonce_resp.text()
-        if not nonce_text.startswith('{'):
-            print("[2/4] Got challenge page, waiting and retrying...")
-            await page.wait_for_timeout(5000)
-            nonce_resp = await context.request.get(
-                "https://prhcomics.com/wp/wp-admin/admin-ajax.php?action=get_nonce"
-            )
-            nonce_text = await nonce_resp.text()
-
-        nonce_data = json.loads(nonce_text)
-        nonce = nonce_data['nonce']
+        browser, context, nonce = await solve_with_browser(p)
         print(f"[2/4] Nonce: {nonce}")
 
         # Fetch all ISBNs via browser context (POST requests)
         print("[3/4] Fetching all ISBNs via browser...")
-        all_isbns = []
-        start = 0
-        rows = 36
-        total = None
-
-        filters_json = json.dumps({
-            "l1_category": "all-categories-manga",
-            "filters": {
-                "category": [],
-                "sale-status": [{"label": "Coming Soon", "filterId": "sale-status", "key": "onSaleFrom", "value": "tomorrow"}],
-                "format": [], "age": [], "grade": [], "guides": [], "publisher": [], "comics_publisher": []
-            }
-        })
-
-        while True:
-            form_data = (
-                f"product_load_nonce={nonce}"
-                f"&action=get_product_list"
-                f"&postType=page"
-                f"&postId=11538"
-                f"&isbns=%5B%5D"
-                f"&params=%7B%22source-page%22%3A%22category-landing-page%22%7D"
-                f"&filters={requests.utils.quote(filters_json)}"
-                f"&layout=grid-lg"
-                f"&start={start}"
-                f"&rows={rows}"
-                f"&sort=frontlistiest_onsale%3Adesc"
-            )
-
-            resp = await context.request.post(
-                "https://prhcomics.com/wp/wp-admin/admin-ajax.php",
-                data=form_data,
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-                    "X-Requested-With": "XMLHttpRequest",
-                    "Referer": "https://prhcomics.com/themes/?catUri=all-categories-manga",
-                }
-            )
-            text = await resp.text()
-
-            try:
-                data = json.loads(text)
-            except json.JSONDecodeError:
-                print(f"  [WARN] JSON decode failed at start={start}, response: {text[:200]}")
-                break
-
-            if not data.get('success'):
-                print(f"  [WARN] API returned success=false at start={start}")
-                break
-
-            isbns = data.get('data', {}).get('isbns', [])
-            if not isbns:
-                content = data.get('data', {}).get('content', '')
-                isbns = re.findall(r'data-isbn="(\d+)"', content)
-
-            page_total = data.get('data', {}).get('total', 0)
-            has_more = data.get('data', {}).get('more', False)
-
-            if not isbns:
-                print(f"  No ISBNs at start={start}, stopping.")
-                break
-
-            if total is None:
-                total = page_total
-                print(f"  Total available: {total}")
-
-            all_isbns.extend(isbns)
-            print(f"  Fetched {len(isbns)} ISBNs at start={start}, cumulative: {len(all_isbns)}/{total}")
-
-            if not has_more:
-                print("  No more pages.")
-                break
-
-            start += rows
-
-        # Deduplicate
-        seen = set()
-        unique_isbns = []
-        for isbn in all_isbns:
-            if isbn not in seen:
-                seen.add(isbn)
-                unique_isbns.append(isbn)
-        all_isbns = unique_isbns
-        print(f"Total unique ISBNs: {len(all_isbns)}")
-
-        if not all_isbns:
-            print("No ISBNs found. Exiting.")
-            await browser.close()
-            return
-
-        # Fetch MD5 for all ISBNs (images2 domain doesn't need anti-bot)
-        print(f"[4/4] Fetching cover MD5 hashes for {len(all_isbns)} ISBNs...")
+        all_isbns = await fetch_all_isbns(context.request, nonce, LISTING_FILTERS, onsale=onsale)
+        if all_isbns and crawl:
+            await crawl(context.request, nonce)
+        await browser.close()
+    return all_isbns
+
+
+def checkpoint_path():
+    return os.path.join(checkpoint_directory, f"{today}.json")
+
+
+def load_checkpoint(restart=False):
+    """Load this run's checkpoint (keyed by run date), or start a new one.
+
+    A new run takes over the covers that earlier runs selected but never
+    finished downloading (see carry_unfinished), since history.db already
+    treats them as current and would not select them again.
+    """
+    path = checkpoint_path()
+    if os.path.exists(path) and not restart:
+        with open(path, 'r') as f:
+            checkpoint = json.load(f)
+        done = [s for s in STAGES if checkpoint['stages'].get(s) == 'done']
+        print(f"Resuming run {today} from {path} (done: {', '.join(done) or 'nothing'})")
+        return checkpoint
+    checkpoint = {'run': today, 'stages': {}}
+    carry_unfinished(checkpoint)
+    return checkpoint
+
+
+def carry_unfinished(checkpoint):
+    """Move the unfinished downloads of earlier runs' checkpoints into `checkpoint['carried']`.
+
+    A cover is unfinished when its download did not succeed, or when the run
+    never uploaded and its TIF is no longer on disk (e.g. a fresh Actions
+    runner). Runs that crashed before selecting fall back to their changed
+    set. Each earlier checkpoint is marked `carried_to` once taken over, after
+    the new checkpoint is saved, so nothing is carried twice or lost.
+    """
+    if not os.path.isdir(checkpoint_directory):
+        return
+    carried = {}
+    sources = []
+    for name in sorted(os.listdir(checkpoint_directory)):
+        run = name[:-len('.json')]
+        if not name.endswith('.json') or run >= today:
+            continue
+        with open(os.path.join(checkpoint_directory, name), 'r') as f:
+            old = json.load(f)
+        if old.get('carried_to') or old['stages'].get('download') == 'done' and old['stages'].get('upload') == 'done':
+            continue
+        downloads = old.get('downloads', {})
+        uploaded = old['stages'].get('upload') == 'done'
+        wanted = dict(old.get('carried', {}), **old.get('selected', old.get('changed', {})))
+        for isbn, md5 in wanted.items():
+            if md5 in compress.PLACEHOLDER_MD5S:
+                continue
+            ok = downloads.get(isbn, {}).get('status') == 'ok'
+            if not ok or not uploaded and not os.path.exists(os.path.join(image_directory, f"{isbn}.tif.{run}")):
+                carried[isbn] = md5
+        sources.append((name, old))
+    if not sources:
+        return
+
+    checkpoint['carried'] = carried
+    save_checkpoint(checkpoint)
+    for name, old in sources:
+        old['carried_to'] = today
+        with open(os.path.join(checkpoint_directory, name), 'w') as f:
+            json.dump(old, f, indent=1, sort_keys=True)
+    print(f"Carrying {len(carried)} unfinished downloads over from {', '.join(n[:-5] for n, _ in sources)}")
+
+
+def save_checkpoint(checkpoint):
+    """Write the checkpoint atomically so a crash never leaves a truncated file."""
+    os.makedirs(checkpoint_directory, exist_ok=True)
+    path = checkpoint_path()
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+async def stage_listing(store, checkpoint):
+    """Fetch the listing (and crawl the catalog with --crawl); stores the ISBNs to probe."""
+    async def crawl(request, nonce):
+        print(f"[3/4] Crawling catalog shards for up to {args.crawl_minutes} minutes...")
+        deadline = time.monotonic() + args.crawl_minutes * 60
+        await crawl_catalog(request, nonce, store, deadline, limiter=DomainRateLimiter(args.listing_rate))
+
+    onsale = {}
+    all_isbns = await fetch_listing(onsale, crawl if args.crawl else None)
+    print(f"Total unique ISBNs: {len(all_isbns)}")
+    if not all_isbns:
+        print("No ISBNs found. Exiting.")
+        return False
+    store.set_onsale(onsale)
+    store.commit()
+
+    if args.crawl:
+        # Crawled ISBNs join the same probe/history pipeline; the scheduler keeps stable ones cheap
+        listed = set(all_isbns)
+        checkpoint['crawled'] = [isbn for isbn in store.catalog() if isbn not in listed]
+        all_isbns += checkpoint['crawled']
+        print(f"With crawled catalog: {len(all_isbns)} ISBNs")
+    checkpoint['isbns'] = all_isbns
+
+
+async def stage_probe(store, checkpoint):
+    """Probe the ISBNs that are due and keep their current MD5s in the checkpoint."""
+    all_isbns = checkpoint['isbns']
+    probe_cache = store.probes()
+    probe_counts = {'unchanged': 0, 'downloaded': 0}
+
+    full_sweep = True
+    if args.schedule:
+        due, intervals, full_sweep = scheduler.select_due(
+            all_isbns, store.change_dates(), store.schedule(), today,
+            store.get_meta('last_full_sweep'), args.sweep_days)
+        histogram = ', '.join(f"{d}d: {n}" for d, n in sorted(Counter(intervals.values()).items()))
+        print(f"Probe schedule: {len(due)}/{len(all_isbns)} ISBNs due"
+              f"{' (full sweep)' if full_sweep else ''}; intervals {{{histogram}}}")
+        all_isbns = due
+
+    # Fetch MD5 for all ISBNs (images2 domain doesn't need anti-bot)
+    print(f"[4/4] Fetching cover MD5 hashes for {len(all_isbns)} ISBNs...")
+    async with Images2Client(initial_concurrency=32, max_concurrency=args.max_concurrency) as client:
+        async def probe_one(isbn):
+            cached = probe_cache.get(isbn) if args.probe != 'full' else None
+            md5, entry = await probe_md5(client, isbn, cached, args.probe)
+            if entry is not None:
+                store.set_probe(isbn, entry)
+                probe_counts['downloaded'] += 1
+            elif md5 is not None:
+                probe_counts['unchanged'] += 1
+            return md5
+
+        md5_results = await asyncio.gather(*(probe_one(isbn) for isbn in all_isbns))
+        print(f"MD5 stage: {client.stats.summary()}, peak concurrency {client.limiter.peak}")
+
+    md5_ok = sum(1 for m in md5_results if m is not None)
+    md5_fail = sum(1 for m in md5_results if m is None)
+    print(f"MD5 fetch complete: {md5_ok} ok, {md5_fail} failed")
+    print(f"Probe ({args.probe}): {probe_counts['unchanged']} unchanged, "
+          f"{probe_counts['downloaded']} downloaded")
+
+    checkpoint['probed'] = {isbn: md5 for isbn, md5 in zip(all_isbns, md5_results) if md5}
+    store.mark_probed(checkpoint['probed'], today)
+    if full_sweep:
+        store.set_meta('last_full_sweep', today)
+    store.commit()
+
+
+async def stage_history(store, checkpoint):
+    """Record changed covers in the history store and decide which ones to download.
+
+    The changed set is saved in the checkpoint before history.db is committed,
+    so a rerun after a crash still downloads covers that history already
+    considers current.
+    """
+    changed = checkpoint.get('changed', {})
+    new = set(checkpoint.get('new', []))
+    new_isbns = 0
+    updated_isbns = 0
+    for isbn, md5 in checkpoint['probed'].items():
+        outcome = store.record(isbn, today, md5)
+        if outcome:
+            changed[isbn] = md5
+            new_isbns += outcome == 'new'
+            updated_isbns += outcome == 'changed'
+            if outcome == 'new':
+                new.add(isbn)
+    checkpoint['changed'] = changed
+    checkpoint['new'] = sorted(new)
+    save_checkpoint(checkpoint)
+    store.commit()
+    print(f"Data update: {new_isbns} new, {updated_isbns} changed, {len(changed)} total changed")
+
+    # Perceptual hashes for cover versions not hashed yet (one thumbnail per MD5)
+    known = store.phashes()
+    unhashed = {}
+    for isbn, md5 in checkpoint['probed'].items():
+        if md5 not in known and md5 not in compress.PLACEHOLDER_MD5S:
+            unhashed.setdefault(md5, isbn)
+    async with Images2Client(initial_concurrency=32, max_concurrency=args.max_concurrency) as client:
+        hashes = await asyncio.gather(*(fetch_dhash(client, isbn) for isbn in unhashed.values()))
+    for md5, dhash in zip(unhashed, hashes):
+        if dhash:
+            store.set_phash(md5, dhash)
+    store.commit()
+    print(f"Perceptual hashes: {sum(1 for h in hashes if h)}/{len(unhashed)} new cover versions hashed")
+
+    selected, kinds = select_downloads(store, changed, args.changes)
+    print("Change kinds: " + ', '.join(f"{k}: {v}" for k, v in sorted(kinds.items())))
+    if len(selected) < len(changed):
+        print(f"Skipping {len(changed) - len(selected)} placeholders, byte-only changes and known reverts "
+              f"(--changes {args.changes})")
+    if args.crawl:
+        selected = defer_crawled(store, checkpoint, selected, new & set(checkpoint.get('crawled', [])))
+    checkpoint['selected'] = selected
+
+    if args.export_json:
+        store.export_json(data_file_path)
+        print(f"Data exported to {data_file_path}")
+
+
+def defer_crawled(store, checkpoint, selected, discovered):
+    """Move covers of ISBNs first seen by the crawl to a backlog and take up to --crawl-downloads from it.
+
+    A first pass over the backlist turns up thousands of new ISBNs: their
+    history is recorded right away, but their TIFs are downloaded a few per
+    run instead of all at once. The backlog ({isbn: md5}) lives in history.db
+    meta; the share drawn from it is kept in the checkpoint so a rerun of
+    this stage does not draw again.
+    """
+    backlog = store.crawl_backlog()
+    for isbn in sorted(discovered):
+        if isbn in selected:
+            backlog[isbn] = selected.pop(isbn)
+    for isbn in selected:
+        # Changed again since it was deferred: downloaded as a normal change
+        backlog.pop(isbn, None)
+    if 'crawl_pulled' not in checkpoint:
+        checkpoint['crawl_pulled'] = dict(itertools.islice(backlog.items(), args.crawl_downloads))
+    for isbn in checkpoint['crawl_pulled']:
+        backlog.pop(isbn, None)
+    selected = dict(selected, **checkpoint['crawl_pulled'])
+
+    save_checkpoint(checkpoint)
+    store.set_meta(CRAWL_BACKLOG_KEY, json.dumps(backlog))
+    store.commit()
+    print(f"Crawl downloads: {len(checkpoint['crawl_pulled'])} taken from the backlog, {len(backlog)} still waiting")
+    return selected
+
+
+def restore_history(store, checkpoint):
+    """Re-apply a finished history stage's probe results to history.db before skipping it.
+
+    Checkpoints are cached even when a run fails, but history.db only reaches
+    the repo when the run succeeds, so a rerun can resume with a checkpoint
+    whose history rows are missing. store.record and mark_probed are
+    idempotent and deferred crawl ISBNs are only added back to the backlog,
+    so this is a no-op when history.db is intact.
+    """
+    restored = sum(1 for isbn, md5 in checkpoint['probed'].items() if store.record(isbn, today, md5))
+    store.mark_probed(checkpoint['probed'], today)
+    deferred = set(checkpoint.get('new', [])) & set(checkpoint.get('crawled', []))
+    deferred -= set(checkpoint.get('selected', {}))
+    if deferred:
+        backlog = store.crawl_backlog()
+        for isbn in sorted(deferred):
+            if checkpoint['changed'][isbn] not in compress.PLACEHOLDER_MD5S:
+                backlog.setdefault(isbn, checkpoint['changed'][isbn])
+        store.set_meta(CRAWL_BACKLOG_KEY, json.dumps(backlog))
+    store.commit()
+    if restored:
+        print(f"Restored {restored} history entries of run {today} missing from history.db")
+        if args.export_json:
+            store.export_json(data_file_path)
+            print(f"Data exported to {data_file_path}")
+
+
+async def stage_download(store, checkpoint):
+    """Download (and encode) the selected and carried-over covers not downloaded yet in this run.
+
+    Returns 'partial' when some downloads failed; a rerun of this run retries
+    them, and otherwise the next run carries them over (see carry_unfinished).
+    """
+    downloads = checkpoint.setdefault('downloads', {})
+    wanted = dict(checkpoint.get('carried', {}), **checkpoint['selected'])
+    pending = {isbn: md5 for isbn, md5 in wanted.items()
+               if downloads.get(isbn, {}).get('status') != 'ok'}
+    if not pending:
+        print("No changed covers to download.")
+        return
+
+    os.makedirs(image_directory, exist_ok=True)
+    print(f"Downloading {len(pending)} changed covers (placeholders skipped, shared covers fetched once)...")
+    async with Images2Client(initial_concurrency=32, max_concurrency=args.max_concurrency) as client:
+        results = await download_and_encode(client, store, group_covers(pending, pending), args.compress,
+                                            args.target_ssim)
+        stats = client.stats
+    store.commit()
+    downloads.update(results)
+    write_download_manifest(downloads)
+    failed = sorted(isbn for isbn, r in results.items() if r['status'] != 'ok')
+    print(f"Cover download complete: {len(results) - len(failed)} ok, {len(failed)} failed; {stats.summary()}")
+    for isbn in failed:
+        print(f"  [WARN] {isbn}: {results[isbn]['error']} after {results[isbn]['attempts']} attempts")
+    if failed:
+        return 'partial'
+
+
+async def stage_upload(store, checkpoint):
+    """Upload the downloaded TIFs to HuggingFace and clear them locally."""
+    if not args.token:
+        print("No --token given, leaving the upload for a later run.")
+        return False
+    if not os.path.isdir(image_directory) or not os.listdir(image_directory):
+        print("Nothing to upload.")
+        return
 
-        if not os.path.exists(image_directory):
-            os.makedirs(image_directory)
+    import subprocess
+    os.environ["HF_TOKEN"] = args.token
+    subprocess.run(f'hf auth login --token={os.environ["HF_TOKEN"]}', shell=True)
 
-        if os.path.exists(data_file_path):
-            with open(data_file_path, 'r') as f:
-                data = json.load(f)
-        else:
-            data = {}
-
-        md5_results = [None] * len(all_isbns)
-
-        def fetch_md5_sync(idx, isbn):
-            try:
-                r = requests.get(f"https://images2.penguinrandomhouse.com/cover/{isbn}?height=1", timeout=15)
-                if r.status_code == 200:
-                    md5_results[idx] = hashlib.md5(r.content).hexdigest()
-            except Exception:
-                pass
-
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-            futures = [executor.submit(fetch_md5_sync, i, isbn) for i, isbn in enumerate(all_isbns)]
-            concurrent.futures.wait(futures)
-
-        md5_ok = sum(1 for m in md5_results if m is not None)
-        md5_fail = sum(1 for m in md5_results if m is None)
-        print(f"MD5 fetch complete: {md5_ok} ok, {md5_fail} failed")
-
-        # Update data
-        changed_isbns = set()
-        new_isbns = 0
-        updated_isbns = 0
-        for isbn, md5 in zip(all_isbns, md5_results):
-            if md5:
-                if isbn not in data:
-                    data[isbn] = [{'date': today, 'md5': md5}]
-                    changed_isbns.add(isbn)
-                    new_isbns += 1
-                elif data[isbn][-1]['md5'] != md5:
-                    data[isbn].append({'date': today, 'md5': md5})
-                    changed_isbns.add(isbn)
-                    updated_isbns += 1
-        print(f"Data update: {new_isbns} new, {updated_isbns} changed, {len(changed_isbns)} total changed")
-
-        # Save data
-        with open(data_file_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        print(f"Data saved to {data_file_path}")
-
-        # Download changed covers (images2 doesn't need anti-bot)
-        if changed_isbns:
-            print(f"Downloading {len(changed_isbns)} changed covers...")
-
-            def download_cover_sync(isbn):
-                try:
-                    r = requests.get(f"https://images2.penguinrandomhouse.com/cover/tif/{isbn}", timeout=30)
-                    if r.status_code == 200:
-                        file_path = os.path.join(image_directory, f"{isbn}.tif.{today}")
-                        with open(file_path, 'wb') as f:
-                            f.write(r.content)
-                except Exception:
-                    pass
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-                futures = [executor.submit(download_cover_sync, isbn) for isbn in changed_isbns]
-                concurrent.futures.wait(futures)
-            print("Cover download complete.")
-        else:
-            print("No changed covers to download.")
+    model_repo_name = "haibaraconan/tiff"
+    upload_folder_to_huggingface(image_directory, model_repo_name)
+    shutil.rmtree(image_directory)
+    print("HuggingFace upload complete.")
 
-        await browser.close()
 
-    print("Done.")
+STAGE_FUNCS = {
+    'listing': stage_listing,
+    'probe': stage_probe,
+    'history': stage_history,
+    'download': stage_download,
+    'upload': stage_upload,
+}
 
 
-# Run main
-asyncio.run(main())
+async def main():
+    """Run the requested stages in order, skipping ones this run's checkpoint already marks done.
+
+    A 'partial' stage (e.g. downloads that failed) lets later stages run but
+    is retried on the next run; rerunning a stage invalidates the ones after it.
+    """
+    checkpoint = load_checkpoint(args.restart)
+    with HistoryStore() as store:
+        for stage in STAGES:
+            if stage not in args.stage:
+                continue
+            if checkpoint['stages'].get(stage) == 'done':
+                print(f"== {stage}: already done in run {today}, skipping")
+                if stage == 'history':
+                    restore_history(store, checkpoint)
+                continue
+            missing = [s for s in STAGES[:STAGES.index(stage)] if checkpoint['stages'].get(s) not in ('done', 'partial')]
+            if missing:
+                print(f"== {stage}: cannot run before {', '.join(missing)}")
+                return
+            print(f"== {stage}")
+            result = await STAGE_FUNCS[stage](store, checkpoint)
+            if result is False:
+                save_checkpoint(checkpoint)
+                return
+            checkpoint['stages'][stage] = 'partial' if result == 'partial' else 'done'
+            for later in STAGES[STAGES.index(stage) + 1:]:
+                checkpoint['stages'].pop(later, None)
+            save_checkpoint(checkpoint)
 
-# HuggingFace upload
-parser = argparse.ArgumentParser()
-parser.add_argument('--token', type=str, help='HuggingFace token')
-args = parser.parse_args()
+    print("Done.")
 
-if args.token:
-    import subprocess
-    os.environ["HF_TOKEN"] = args.token
-    subprocess.run(f'hf auth login --token={os.environ["HF_TOKEN"]}', shell=True)
 
+def upload_folder_to_huggingface(folder_path, model_repo_name, repo_type="model"):
     from huggingface_hub import HfApi
 
-    def upload_folder_to_huggingface(folder_path, model_repo_name, repo_type="model"):
-        api = HfApi()
-        path_in_repo = ""
-        if os.path.exists(os.path.join(SCRIPT_DIR, "path_in_repo.txt")):
-            with open(os.path.join(SCRIPT_DIR, "path_in_repo.txt"), "r") as file:
-                path_in_repo = file.read().strip()
-
-        files = api.list_repo_files(repo_id=model_repo_name, repo_type=repo_type)
-        count = sum(1 for file in files if file.startswith(path_in_repo))
-
-        if count > 9000:
-            num = int(re.search(r"\d+", path_in_repo).group()) if path_in_repo else 0
-            new_path_in_repo = f"{num + 1}pengui/"
-            with open(os.path.join(SCRIPT_DIR, "path_in_repo.txt"), "w") as file:
-                file.write(new_path_in_repo)
-            path_in_repo = new_path_in_repo
-
-        api.upload_folder(
-            folder_path=folder_path,
-            repo_id=model_repo_name,
-            repo_type=repo_type,
-            path_in_repo=path_in_repo
-        )
-
-    model_repo_name = "haibaraconan/tiff"
-    upload_folder_to_huggingface(image_directory, model_repo_name)
-    shutil.rmtree(image_directory)
-    print("HuggingFace upload complete.")
+    api = HfApi()
+    path_in_repo = ""
+    if os.path.exists(os.path.join(SCRIPT_DIR, "path_in_repo.txt")):
+        with open(os.path.join(SCRIPT_DIR, "path_in_repo.txt"), "r") as file:
+            path_in_repo = file.read().strip()
+
+    files = api.list_repo_files(repo_id=model_repo_name, repo_type=repo_type)
+    count = sum(1 for file in files if file.startswith(path_in_repo))
+
+    if count > 9000:
+        num = int(re.search(r"\d+", path_in_repo).group()) if path_in_repo else 0
+        new_path_in_repo = f"{num + 1}pengui/"
+        with open(os.path.join(SCRIPT_DIR, "path_in_repo.txt"), "w") as file:
+            file.write(new_path_in_repo)
+        path_in_repo = new_path_in_repo
+
+    api.upload_folder(
+        folder_path=folder_path,
+        repo_id=model_repo_name,
+        repo_type=repo_type,
+        path_in_repo=path_in_repo,
+        ignore_patterns=["*.part"],
+    )
+
+
+if __name__ == '__main__':
+    # Guarded so encode worker processes can import this module safely
+    args = parser.parse_args()
+    if args.run:
+        today = args.run
+    asyncio.run(main())
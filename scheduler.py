@@ -0,0 +1,67 @@
+"""
+Change-likelihood probe scheduler for run.py.
+
+Instead of MD5-probing every listed ISBN every day, each ISBN gets a probe
+interval from its history in history.db: ISBNs that are new, changed
+recently, change often or are close to their on-sale date are probed daily,
+and stable ones progressively less often, up to MAX_INTERVAL days. Every
+FULL_SWEEP_DAYS days all ISBNs are probed regardless, so a missed change is
+never more than one sweep old.
+"""
+
+from datetime import date
+
+HOT_DAYS = 14             # Changed within this many days: probe daily
+ONSALE_WINDOW = (-30, 14)  # Days before/after the on-sale date when covers get finalised
+BUSY_CHANGES = 3          # This many changes within BUSY_DAYS also counts as hot
+BUSY_DAYS = 90
+STABLE_STEP = 30          # +1 day of interval per this many days without a change
+MAX_INTERVAL = 7
+FULL_SWEEP_DAYS = 7
+
+
+def days_between(earlier, later):
+    return (date.fromisoformat(later) - date.fromisoformat(earlier)).days
+
+
+def probe_interval(dates, onsale, today):
+    """Days between probes for one ISBN.
+
+    `dates` are its change dates (oldest first, empty for a new ISBN) and
+    `onsale` its on-sale date (YYYY-MM-DD) or None.
+    """
+    if not dates:
+        return 1
+    if onsale and ONSALE_WINDOW[0] <= days_between(onsale, today) <= ONSALE_WINDOW[1]:
+        return 1
+    quiet = days_between(dates[-1], today)
+    if quiet <= HOT_DAYS:
+        return 1
+    if sum(1 for d in dates if days_between(d, today) <= BUSY_DAYS) >= BUSY_CHANGES:
+        return 1
+    interval = 1 + quiet // STABLE_STEP
+    if len(dates) > 1:
+        # Covers with a history of frequent changes stay on a shorter leash
+        mean_gap = days_between(dates[0], dates[-1]) / (len(dates) - 1)
+        interval = min(interval, max(1, int(mean_gap // 2)))
+    return min(interval, MAX_INTERVAL)
+
+
+def select_due(isbns, change_dates, schedule, today, last_sweep=None, sweep_days=FULL_SWEEP_DAYS):
+    """Pick the ISBNs to probe today; returns (due, intervals, full_sweep).
+
+    `change_dates` maps ISBN -> change dates, `schedule` ISBN -> {'onsale',
+    'last_probed'}. Everything is due when the last full sweep is at least
+    `sweep_days` old (or never happened).
+    """
+    full_sweep = last_sweep is None or days_between(last_sweep, today) >= sweep_days
+    due = []
+    intervals = {}
+    for isbn in isbns:
+        entry = schedule.get(isbn, {})
+        interval = probe_interval(change_dates.get(isbn, []), entry.get('onsale'), today)
+        intervals[isbn] = interval
+        last_probed = entry.get('last_probed')
+        if full_sweep or not last_probed or days_between(last_probed, today) >= interval:
+            due.append(isbn)
+    return due, intervals, full_sweep
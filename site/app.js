@@ -1,56 +1,94 @@
 (function () {
   'use strict';
 
-  let allData = {};
-
-  async function loadData() {
-    const resp = await fetch('data.json');
-    allData = await resp.json();
-
-    // Build date → isbns index
-    const dateMap = {};
-    for (const [isbn, entries] of Object.entries(allData)) {
-      for (const entry of entries) {
-        if (!dateMap[entry.date]) dateMap[entry.date] = [];
-        dateMap[entry.date].push(isbn);
-      }
+  const gallery = document.getElementById('gallery');
+  const sentinel = document.createElement('div');
+  sentinel.className = 'loading';
+
+  // Rendered tile width per breakpoint (see style.css grid columns)
+  const SIZES = '(max-width: 380px) 50vw, (max-width: 767px) 34vw, (max-width: 900px) 25vw, 240px';
+
+  let shards = [];
+  let next = 0;
+  let loading = false;
+
+  async function loadManifest() {
+    const resp = await fetch('data/manifest.json');
+    const manifest = await resp.json();
+    shards = manifest.shards;
+
+    gallery.after(sentinel);
+    await loadNextShard();
+
+    if (!gallery.children.length) {
+      gallery.innerHTML = '<div class="loading">No images available.</div>';
+      return;
     }
 
-    // Sort dates descending (newest first)
-    const dates = Object.keys(dateMap).sort().reverse();
+    // Fetch older months as the user nears the bottom of the page
+    const observer = new IntersectionObserver(function (items) {
+      if (items[0].isIntersecting) loadNextShard();
+    }, { rootMargin: '1500px 0px' });
+    observer.observe(sentinel);
+  }
+
+  async function loadNextShard() {
+    if (loading || next >= shards.length) return;
+    loading = true;
+    const shard = shards[next++];
+    sentinel.textContent = 'Loading…';
+
+    const resp = await fetch(shard.file);
+    const dates = await resp.json();
+    gallery.insertAdjacentHTML('beforeend', renderShard(dates));
+
+    loading = false;
+    if (next >= shards.length) {
+      sentinel.remove();
+    } else {
+      sentinel.textContent = '';
+      // Keep filling while the sentinel is still on screen (short months)
+      const rect = sentinel.getBoundingClientRect();
+      if (rect.top < window.innerHeight + 1500) loadNextShard();
+    }
+  }
 
-    const gallery = document.getElementById('gallery');
+  function renderShard(dates) {
     let html = '';
 
-    for (const date of dates) {
-      const isbns = [...new Set(dateMap[date])].sort();
+    // Shards list dates newest first, each with sorted [isbn, img, w, h, lqip, srcset?] items
+    for (const [date, items] of Object.entries(dates)) {
       const dateObj = new Date(date + 'T00:00:00');
       const dateLabel = dateObj.toLocaleDateString('zh-CN', {
         year: 'numeric', month: 'long', day: 'numeric'
       });
 
       html += `<div class="date-group">`;
-      html += `<div class="date-header">${dateLabel}<span class="date-count">${isbns.length}</span></div>`;
+      html += `<div class="date-header">${dateLabel}<span class="date-count">${items.length}</span></div>`;
       html += `<div class="grid">`;
 
-      for (const isbn of isbns) {
-        const subdir = getSubdir(isbn);
-        html += `<div class="item"><img src="img/${subdir}/${isbn}.avif" alt="${isbn}" loading="lazy" onerror="this.parentElement.style.display='none'"></div>`;
+      for (const [isbn, img, w, h, lqip, srcset] of items) {
+        // Intrinsic size and an inline blurred placeholder keep the grid stable while images load
+        const tag = `<img src="img/${img}" alt="${isbn}" width="${w}" height="${h}" loading="lazy" decoding="async">`;
+        html += `<div class="item" style="background-image:url(${lqip})">${srcset ? renderPicture(srcset, tag) : tag}</div>`;
       }
 
       html += `</div></div>`;
     }
 
-    gallery.innerHTML = html || '<div class="loading">No images available.</div>';
+    return html;
   }
 
-  function getSubdir(isbn) {
-    let h = 0;
-    for (let i = 0; i < isbn.length; i++) {
-      h = (h * 31 + isbn.charCodeAt(i)) & 0x7fffffff;
+  // <picture> with one <source> per format (AVIF first), letting the browser pick the width
+  function renderPicture(srcset, tag) {
+    let html = '<picture>';
+    for (const format of ['avif', 'webp']) {
+      if (!srcset[format]) continue;
+      const candidates = srcset[format].map(([path, width]) => `img/${path} ${width}w`).join(', ');
+      html += `<source type="image/${format}" srcset="${candidates}" sizes="${SIZES}">`;
     }
-    return String(h % 1000).padStart(3, '0');
+    return html + tag + '</picture>';
   }
 
-  loadData();
+  loadManifest();
 })();